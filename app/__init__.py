@@ -1,10 +1,11 @@
 import logging
 
-import sentry_sdk
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from mangum import Mangum
-from sentry_sdk.integrations.logging import LoggingIntegration
 
+from app import home, warmup, worker
+from app.timing import TimingMiddleware
 from app.v1 import actions, authorization, events
 from app.settings import settings
 
@@ -15,14 +16,53 @@ def before_send(event, hint):
     return event  # pragma: no cover
 
 
-sentry_logging = LoggingIntegration(level=logging.INFO, event_level=logging.ERROR)
-sentry_sdk.init(dsn=settings.SENTRY_DNS, integrations=[sentry_logging], before_send=before_send)
+def init_sentry():
+    import sentry_sdk
+    from sentry_sdk.integrations.logging import LoggingIntegration
 
-app = FastAPI(title='atodeyomu')
+    sentry_logging = LoggingIntegration(level=logging.INFO, event_level=logging.ERROR)
+    # 自動で有効になる連携はaiohttpなどインストールされているライブラリをすべて読み込み、コールドスタートを遅くするため使わない
+    sentry_sdk.init(
+        dsn=settings.SENTRY_DNS,
+        integrations=[sentry_logging],
+        auto_enabling_integrations=False,
+        before_send=before_send,
+    )
+
+
+init_sentry()
+
+app = FastAPI(title='atodeyomu', default_response_class=ORJSONResponse)
 if settings.ENVIRONMENT_NAME == 'local':
     app.debug = True
 
+app.add_middleware(TimingMiddleware)
 app.include_router(actions.router, prefix='/v1')
 app.include_router(authorization.router, prefix='/v1')
 app.include_router(events.router, prefix='/v1')
-app_handler = Mangum(app)
+
+
+@app.get('/healthz', include_in_schema=False)
+async def healthz():
+    return {'status': 'ok'}
+
+
+# Mangumでは呼び出しごとにstartupとshutdownが実行されるため、温める処理と接続を閉じる処理は常駐する場合だけ行う
+if settings.LONG_RUNNING:
+    app.add_event_handler('startup', warmup.warm_up)
+# Lambdaが停止する前、またはSIGTERMでプロセスが終了する前にキューに残った処理を終える
+app.add_event_handler('shutdown', worker.drain)
+app.add_event_handler('shutdown', home.drain)
+if settings.LONG_RUNNING:
+    app.add_event_handler('shutdown', warmup.close_connections)
+asgi_handler = Mangum(app)
+
+
+def app_handler(event, context):
+    """Lambdaのエントリーポイント
+
+    スケジュール実行で送られたイベントではキャッシュと接続を温め、それ以外はAPI Gatewayのリクエストとして処理する
+    """
+    if warmup.is_warm_up_event(event):
+        return warmup.handler(event, context)
+    return asgi_handler(event, context)
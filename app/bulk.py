@@ -0,0 +1,142 @@
+"""保存したメッセージをまとめて既読にする
+
+ユーザーとのDMから「読んだ」ボタンのあるメッセージを古い方へ順に探して削除し、最後にSavedItemをすべて既読にする。
+chat.deleteはレート制限の厳しいTier 3のため、並行数を制限してレート制限付きのクライアントで呼び出す。
+Lambdaでは残り時間が少なくなったら、処理した位置をMarkAllJobに入れて非同期に呼び出し直し、続きから処理する。
+進み具合は1通のDMを更新してユーザーに伝える。
+"""
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from app import home, metrics, timing, worker
+from app.models import SavedItem, TeamConf
+from app.settings import settings
+
+if TYPE_CHECKING:
+    from slack_sdk.web.async_client import AsyncWebClient
+
+logger = logging.getLogger(__name__)
+
+
+class MarkAllJob(BaseModel):
+    team_id: str
+    user: str
+    channel: Optional[str] = None  # ユーザーとのDMのチャンネル
+    latest: Optional[str] = None  # 続きを探すメッセージのts。これより古いメッセージを探す
+    progress_ts: Optional[str] = None  # 進み具合を伝えるDMのts
+    deleted: int = 0
+
+
+def is_saved_message(message: Dict[str, Any]) -> bool:
+    """「読んだ」ボタンのあるメッセージか"""
+    for block in message.get('blocks') or []:
+        for element in block.get('elements') or []:
+            if element.get('action_id') == 'mark_as_read':
+                return True
+    return False
+
+
+async def delete_messages(client: 'AsyncWebClient', channel: str, ts_list: List[str]) -> int:
+    """メッセージを並行して削除し、削除した件数を返す"""
+    from slack_sdk.errors import SlackApiError
+
+    semaphore = asyncio.Semaphore(settings.MARK_ALL_CONCURRENCY)
+
+    async def delete(ts: str) -> bool:
+        async with semaphore:
+            try:
+                await client.chat_delete(channel=channel, ts=ts)
+            except SlackApiError as e:
+                # ユーザーが「読んだ」ボタンを押して先に削除された場合
+                if e.response.get('error') == 'message_not_found':
+                    return False
+                raise
+            return True
+
+    results = await asyncio.gather(*(delete(ts) for ts in ts_list))
+    return sum(results)
+
+
+async def run(job: MarkAllJob, remaining: Callable[[], float]) -> Optional[MarkAllJob]:
+    """DMを古い方へ順に削除する
+
+    remainingが返す残り秒数が少なくなったら処理を止め、続きを処理するためのMarkAllJobを返す。終わった場合はNoneを返す
+    """
+    from app.slack import get_client
+    team_conf = TeamConf.get(job.team_id)
+    client = get_client(team_conf.team_id, team_conf.access_token)
+    if job.channel is None:
+        job.channel = (await client.conversations_open(users=job.user))['channel']['id']
+    if job.progress_ts is None:
+        response = await client.chat_postMessage(channel=job.channel, text='保存したメッセージをまとめて既読にしています')
+        job.progress_ts = response['ts']
+    while True:
+        if remaining() < settings.MARK_ALL_MIN_REMAINING:
+            metrics.incr('mark_all.resumed')
+            return job
+        response = await client.conversations_history(
+            channel=job.channel,
+            latest=job.latest,
+            limit=settings.MARK_ALL_PAGE_SIZE,
+        )
+        messages = response['messages']
+        job.deleted += await delete_messages(client, job.channel,
+                                             [message['ts'] for message in messages if is_saved_message(message)])
+        if messages:
+            job.latest = messages[-1]['ts']
+        if not response.get('has_more') or not messages:
+            break
+        await client.chat_update(
+            channel=job.channel,
+            ts=job.progress_ts,
+            text=f'保存したメッセージをまとめて既読にしています（{job.deleted}件）',
+        )
+    SavedItem.mark_all_as_read(job.team_id, job.user)
+    await client.chat_update(channel=job.channel, ts=job.progress_ts, text=f'{job.deleted}件のメッセージを既読にしました')
+    await home.refresh(team_conf, job.user)
+    metrics.incr('mark_all.deleted', job.deleted)
+    return None
+
+
+def invoke(job: MarkAllJob):
+    """MARK_ALL_FUNCTIONのLambdaを非同期に呼び出す"""
+    assert settings.MARK_ALL_FUNCTION
+    worker.invoke(settings.MARK_ALL_FUNCTION, job.dict())
+
+
+async def run_in_worker(job: MarkAllJob):
+    await run(job, lambda: float('inf'))
+
+
+async def start(team_id: str, user: str):
+    """まとめて既読にする処理を始める
+
+    LambdaではSlackに応答を返す前に終わらないため、別のLambdaに任せる。常駐する場合はワーカーで処理する
+    """
+    job = MarkAllJob(team_id=team_id, user=user)
+    if settings.MARK_ALL_FUNCTION:
+        await asyncio.get_event_loop().run_in_executor(None, invoke, job)
+    else:
+        await worker.queue.enqueue(run_in_worker, job)
+
+
+def handler(event: Dict[str, Any], context: Any):
+    """非同期に呼び出されるLambdaのエントリーポイント
+
+    残り時間が少なくなったら続きを処理するために自身を呼び出し直す
+    """
+    from sentry_sdk.integrations.serverless import serverless_function
+
+    def mark_all():
+        job = MarkAllJob.parse_obj(event)
+        with timing.measure('mark_all'):
+            timing.set_team(job.team_id)
+            rest = asyncio.get_event_loop().run_until_complete(
+                run(job, lambda: context.get_remaining_time_in_millis() / 1000))
+        if rest is not None:
+            invoke(rest)
+
+    serverless_function(mark_all)()
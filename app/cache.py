@@ -0,0 +1,91 @@
+"""プロセス内で共有するキャッシュ
+
+Lambdaのコンテナやuvicornのワーカーが生きている間だけ保持される。
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Generic, Hashable, List, Optional, TypeVar
+
+from app import metrics
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+_MISSING = object()
+_caches: List['TTLCache'] = []
+
+
+class TTLCache(Generic[K, V]):
+    """TTLで失効し、容量を超えたら最も古く参照されたものから追い出すキャッシュ
+
+    ttlにNoneを指定した場合は失効しない
+    """
+    def __init__(self, name: str, maxsize: int, ttl: Optional[float] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: 'OrderedDict[K, tuple]' = OrderedDict()
+        self._lock = Lock()
+        _caches.append(self)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key: K, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] is not None and item[1] <= time.monotonic():
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+        metrics.incr(f'cache.{self.name}.hit' if item is not None else f'cache.{self.name}.miss')
+        return default if item is None else item[0]
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None):
+        """ttlを指定した場合はこの値だけキャッシュのttlの代わりに使う"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: K, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def clear_caches():
+    """全てのキャッシュを空にする"""
+    for cache in _caches:
+        cache.clear()
+
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    return {cache.name: cache.stats() for cache in _caches}
@@ -1,15 +1,121 @@
+"""Slackからのリクエストの検証と読み込み
+
+リクエストのボディは1回だけ読み込み、署名の検証とpayloadの読み込みで同じbytesを使う。
+"""
+import binascii
+import hashlib
+import hmac
+import re
+import time
+import urllib.parse
+from functools import lru_cache
 from http import HTTPStatus
+from typing import Any, Dict, Optional
 
-from fastapi import HTTPException, Request
-from slack_sdk.signature import SignatureVerifier
+import orjson
+from fastapi import Depends, HTTPException, Request
 
+from app import timing
 from app.settings import settings
 
+# 署名のタイムスタンプの許容範囲（秒）
+TIMESTAMP_TOLERANCE = 60 * 5
+# quoted-printableのデコーダーではunquote_plusと結果が変わる値。16進数2桁が続かない%と、そのままの=や改行
+_NOT_QP_SAFE = re.compile(rb'%(?![0-9A-Fa-f]{2})|[=\r\n]')
+
+
+class SignatureVerifier:
+    """slack_sdk.signature.SignatureVerifierと同じ署名を、ボディをstrに変換せずに計算する"""
+    def __init__(self, signing_secret: str):
+        self.signing_secret = signing_secret.encode('utf-8')
+
+    def generate_signature(self, timestamp: str, body: bytes) -> str:
+        message = b'v0:' + timestamp.encode('ascii') + b':' + body
+        return 'v0=' + hmac.new(self.signing_secret, message, hashlib.sha256).hexdigest()
+
+    def is_valid(self, body: bytes, timestamp: Optional[str], signature: Optional[str]) -> bool:
+        if not timestamp or not signature:
+            return False
+        try:
+            issued_at = int(timestamp)
+        except ValueError:
+            return False
+        # 再送攻撃を防ぐため古いリクエストを拒否する。HMACを計算する前に判定する
+        if abs(time.time() - issued_at) > TIMESTAMP_TOLERANCE:
+            return False
+        return hmac.compare_digest(self.generate_signature(timestamp, body), signature)
+
 
-async def verify_signature(request: Request) -> bool:
+@lru_cache()
+def get_verifier() -> SignatureVerifier:
+    return SignatureVerifier(settings.SLACK_SIGNING_SECRET)
+
+
+async def raw_body(request: Request) -> bytes:
+    return await request.body()
+
+
+async def verify_signature(request: Request, body: bytes = Depends(raw_body)) -> bool:
     # リクエストの署名を検証
     # ref: https://api.slack.com/authentication/verifying-requests-from-slack
-    verifier = SignatureVerifier(settings.SLACK_SIGNING_SECRET)
-    if verifier.is_valid_request(await request.body(), dict(request.headers)):
+    with timing.phase('verify_signature'):
+        valid = get_verifier().is_valid(
+            body,
+            request.headers.get('x-slack-request-timestamp'),
+            request.headers.get('x-slack-signature'),
+        )
+    if valid:
         return True
     raise HTTPException(HTTPStatus.FORBIDDEN)
+
+
+def unquote_plus(value: bytes) -> bytes:
+    """application/x-www-form-urlencodedの値をデコードする
+
+    urllib.parse.unquote_plusはpayloadのJSONのように%エスケープが多いと遅いため、
+    %XXを=XXに置き換えてCで実装されたquoted-printableのデコーダーで処理する。
+    末尾の%や%zzのように正しくエンコードされていない値は、quoted-printableでは結果が変わるためurllibでデコードする
+
+    >>> unquote_plus(b'%7B%22text%22%3A+%22%E3%81%82%3D%22%7D')
+    b'{"text": "\\xe3\\x81\\x82="}'
+    >>> unquote_plus(b'100%25+%zz%')
+    b'100% %zz%'
+    """
+    value = value.replace(b'+', b' ')
+    if _NOT_QP_SAFE.search(value):
+        return urllib.parse.unquote_to_bytes(value)
+    return binascii.a2b_qp(value.replace(b'%', b'='))
+
+
+def parse_form(body: bytes) -> Dict[str, str]:
+    form = {}
+    for field in body.split(b'&'):
+        if field:
+            key, _, value = field.partition(b'=')
+            form[unquote_plus(key).decode('utf-8')] = unquote_plus(value).decode('utf-8')
+    return form
+
+
+def decode_body(body: bytes, content_type: str) -> Dict[str, Any]:
+    """Slackから送られたボディを読み込む
+
+    Interactivityのpayloadはフォームのpayloadに、Events APIはJSONでそのまま送られる
+    """
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        form = parse_form(body)
+        if 'payload' in form:
+            return orjson.loads(form['payload'])
+        return form
+    return orjson.loads(body) if body else {}
+
+
+async def slack_payload(request: Request, body: bytes = Depends(raw_body)) -> Dict[str, Any]:
+    """ボディを読み込んだpayloadをrequest.stateに保存して返す"""
+    try:
+        payload = decode_body(body, request.headers.get('content-type', ''))
+    except ValueError:
+        raise HTTPException(HTTPStatus.BAD_REQUEST)
+    if not isinstance(payload, dict):
+        raise HTTPException(HTTPStatus.BAD_REQUEST)
+    request.state.slack_payload = payload
+    return payload
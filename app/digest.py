@@ -0,0 +1,101 @@
+"""保存したメッセージをまとめてDMで送る
+
+TeamConf.delivery_modeがDIGESTのチームは、リアクションされたメッセージをDigestItemに保存しておき、
+スケジュール実行される handler でユーザーごとに1通のDMにまとめて送る。
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import TYPE_CHECKING, Dict, List
+
+from app import metrics
+from app.models import DigestItem, TeamConf
+from app.settings import settings
+
+if TYPE_CHECKING:
+    from slack_sdk.models.blocks import Block
+
+logger = logging.getLogger(__name__)
+
+ITEM_BLOCK_PREFIX = 'item:'
+
+
+def item_blocks(item_key: str, permalink: str) -> List['Block']:
+    """メッセージ1件分のリンクと「読んだ」ボタン
+
+    ボタンのvalueにitem_keyを入れ、押されたときに該当するブロックだけを取り除けるようにする
+    """
+    from slack_sdk.models.blocks import MarkdownTextObject
+    from slack_sdk.models.blocks.block_elements import ButtonElement
+    from slack_sdk.models.blocks.blocks import ActionsBlock, SectionBlock
+
+    return [
+        SectionBlock(block_id=f'{ITEM_BLOCK_PREFIX}{item_key}', text=MarkdownTextObject(text=f'<{permalink}>')),
+        ActionsBlock(
+            block_id=f'{ITEM_BLOCK_PREFIX}{item_key}:actions',
+            elements=[ButtonElement(text='読んだ', action_id='mark_as_read', value=item_key)],
+        ),
+    ]
+
+
+def remove_item_blocks(blocks: List[dict], item_key: str) -> List[dict]:
+    """DMのブロックから指定したメッセージのブロックを取り除く"""
+    block_ids = {f'{ITEM_BLOCK_PREFIX}{item_key}', f'{ITEM_BLOCK_PREFIX}{item_key}:actions'}
+    return [block for block in blocks if block.get('block_id') not in block_ids]
+
+
+def has_item_blocks(blocks: List[dict]) -> bool:
+    return any(block.get('block_id', '').startswith(ITEM_BLOCK_PREFIX) for block in blocks)
+
+
+async def deliver(items: List[DigestItem]):
+    """1人のユーザーに保存されたメッセージをまとめて送る"""
+    from slack_sdk.models.blocks import MarkdownTextObject, SectionBlock
+
+    from app.slack import get_client
+    try:
+        team_conf = TeamConf.get(items[0].team_id)
+    except TeamConf.DoesNotExist:
+        logger.warning('team_conf does not exist: %s', items[0].team_id)
+        return
+    # 送りきれなかったものは次回に送る
+    items = sorted(items, key=lambda item: item.created_at)[:settings.DIGEST_MAX_ITEMS]
+    blocks: List['Block'] = [SectionBlock(text=MarkdownTextObject(text=f'あとで読むメッセージが{len(items)}件あります'))]
+    for item in items:
+        blocks += item_blocks(item.item_key, item.permalink)
+    client = get_client(team_conf.team_id, team_conf.access_token)
+    await client.chat_postMessage(
+        text=f'あとで読むメッセージが{len(items)}件あります',
+        channel=items[0].user,
+        blocks=blocks,
+        unfurl_links=False,
+    )
+    with DigestItem.batch_write() as batch:
+        for item in items:
+            batch.delete(item)
+    metrics.incr('digest.delivered_messages')
+    metrics.incr('digest.delivered_items', len(items))
+
+
+async def flush():
+    """保存されているメッセージをユーザーごとにまとめて送る"""
+    pending: Dict[str, List[DigestItem]] = defaultdict(list)
+    for item in DigestItem.scan():
+        pending[item.team_user].append(item)
+    semaphore = asyncio.Semaphore(settings.WORKER_CONCURRENCY)
+
+    async def run(items: List[DigestItem]):
+        async with semaphore:
+            try:
+                await deliver(items)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    await asyncio.gather(*(run(items) for items in pending.values()))
+
+
+def handler(event, context):
+    """スケジュール実行されるLambdaのエントリーポイント"""
+    from sentry_sdk.integrations.serverless import serverless_function
+
+    serverless_function(lambda: asyncio.get_event_loop().run_until_complete(flush()))()
@@ -0,0 +1,100 @@
+"""ワークスペースで使えるemoji"""
+from functools import lru_cache
+from pathlib import Path
+from typing import TYPE_CHECKING, Collection, FrozenSet, Iterable, Optional, Set
+
+from app import metrics
+from app.cache import TTLCache
+from app.singleflight import SingleFlight
+from app.settings import settings
+
+if TYPE_CHECKING:
+    from slack_sdk.web.async_client import AsyncWebClient
+
+# scripts/build_emoji_index.py で生成したUnicodeのemojiの名前の一覧
+UNICODE_EMOJI_PATH = Path(__file__).with_name('unicode_emoji.txt')
+
+# team_idをキーにカスタムemojiの名前のsetを保持するキャッシュ
+custom_emoji_cache: TTLCache[str, Set[str]] = TTLCache(
+    'custom_emoji',
+    maxsize=256,
+    ttl=settings.CUSTOM_EMOJI_CACHE_TTL,
+)
+custom_emoji_flight: SingleFlight[str, Set[str]] = SingleFlight('custom_emoji')
+# emoji.listを呼び出したteam_id。ここにある間は見つからない名前があっても呼び出し直さない
+custom_emoji_loaded: TTLCache[str, bool] = TTLCache(
+    'custom_emoji_loaded',
+    maxsize=256,
+    ttl=settings.CUSTOM_EMOJI_REFETCH_INTERVAL,
+)
+
+
+@lru_cache(maxsize=None)
+def unicode_emoji() -> FrozenSet[str]:
+    """Unicodeのemojiの名前のsetを返す
+
+    初めて参照されたときに読み込む
+    """
+    return frozenset(UNICODE_EMOJI_PATH.read_text(encoding='utf-8').split())
+
+
+def normalize(name: str) -> str:
+    """emojiの名前から前後のコロンと肌の色の指定を取り除く
+
+    >>> normalize(':+1::skin-tone-3:')
+    '+1'
+    """
+    return name.strip(':').split('::', 1)[0]
+
+
+def is_unicode_emoji(name: str) -> bool:
+    return normalize(name) in unicode_emoji()
+
+
+async def get_custom_emoji(team_id: str, client: 'AsyncWebClient', expected: Collection[str] = ()) -> Set[str]:
+    """ワークスペースのカスタムemojiの名前を返す
+
+    キャッシュがない場合だけemoji.listを呼び出し、以降はemoji_changedイベントで更新する。
+    emoji_changedイベントは1つのコンテナにしか届かないため、expectedの名前がキャッシュにない場合は
+    CUSTOM_EMOJI_REFETCH_INTERVAL秒に1回までemoji.listを呼び出し直す
+    """
+    names = custom_emoji_cache.get(team_id)
+    if names is not None and not names.issuperset(expected) and team_id not in custom_emoji_loaded:
+        metrics.incr('custom_emoji.refetched')
+        names = None
+    if names is None:
+        names = await custom_emoji_flight.do(team_id, lambda: _load_custom_emoji(team_id, client))
+    return names
+
+
+async def _load_custom_emoji(team_id: str, client: 'AsyncWebClient') -> Set[str]:
+    response = await client.emoji_list()
+    names = set(response.get('emoji').keys())
+    custom_emoji_cache.set(team_id, names)
+    custom_emoji_loaded.set(team_id, True)
+    return names
+
+
+def apply_emoji_changed(
+    team_id: str,
+    subtype: Optional[str],
+    name: Optional[str] = None,
+    names: Optional[Iterable[str]] = None,
+    old_name: Optional[str] = None,
+    new_name: Optional[str] = None,
+):
+    """emoji_changedイベントの内容をキャッシュに反映する
+
+    ref: https://api.slack.com/events/emoji_changed
+    """
+    cached = custom_emoji_cache.get(team_id)
+    if cached is None:
+        # キャッシュがなければ次にemoji.listを呼び出したときに最新の状態になる
+        return
+    if subtype == 'add' and name:
+        cached.add(name)
+    elif subtype == 'remove' and names:
+        cached.difference_update(names)
+    elif subtype == 'rename' and old_name and new_name:
+        cached.discard(old_name)
+        cached.add(new_name)
@@ -0,0 +1,167 @@
+"""App Homeに未読のメッセージの一覧を表示する
+
+app_home_opened のたびに一覧を組み立てて views.publish を呼ばないよう、ユーザーごとに組み立てたビューをキャッシュし、
+表示されているビューと同じ場合は公開しない。
+保存や既読で一覧が変わった場合はキャッシュを捨て、HOME_PUBLISH_DELAY 秒待ってから1回だけ views.publish する。
+"""
+import asyncio
+import hashlib
+import logging
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+import orjson
+
+from app import metrics
+from app.cache import TTLCache
+from app.digest import item_blocks
+from app.models import SavedItem, TeamConf
+from app.settings import settings
+
+if TYPE_CHECKING:
+    from slack_sdk.models.blocks import Block
+
+logger = logging.getLogger(__name__)
+
+# 1ページ目に戻るボタンのvalue
+FIRST_PAGE = 'first'
+
+# 1ページ目のビュー。キーは{team_id}:{user_id}
+home_view_cache: TTLCache[str, Dict[str, Any]] = TTLCache(
+    'home_view',
+    maxsize=settings.HOME_VIEW_CACHE_SIZE,
+    ttl=settings.HOME_VIEW_CACHE_TTL,
+)
+
+# App Homeに公開したビューのprivate_metadata。一覧が変わったときに描画し直すのは、ここにあるユーザーだけにする
+home_published_cache: TTLCache[str, str] = TTLCache(
+    'home_published',
+    maxsize=settings.HOME_VIEW_CACHE_SIZE,
+    ttl=settings.HOME_ACTIVE_TTL,
+)
+
+# 描画し直すのを待っているタスクと、待たずに描画させるためのイベント。キーは{team_id}:{user_id}
+_pending: Dict[str, Tuple[asyncio.Task, asyncio.Event]] = {}
+
+
+def fingerprint(blocks: List[Dict[str, Any]]) -> str:
+    """ビューの内容のハッシュ。private_metadataに入れ、表示されているビューと同じか判定する"""
+    return hashlib.sha256(orjson.dumps(blocks)).hexdigest()[:32]
+
+
+def render(team_id: str, user: str, cursor: Optional[str] = None) -> Dict[str, Any]:
+    """未読のメッセージの一覧を1ページ分組み立てる"""
+    from slack_sdk.models.blocks import ActionsBlock, ButtonElement, HeaderBlock, MarkdownTextObject, SectionBlock
+
+    items, next_cursor = SavedItem.page(team_id, user, limit=settings.HOME_PAGE_SIZE, cursor=cursor, unread=True)
+    blocks: List['Block'] = [HeaderBlock(text='あとで読むメッセージ')]
+    if not items and cursor is None:
+        blocks.append(SectionBlock(text=MarkdownTextObject(text='未読のメッセージはありません')))
+    elif cursor is None:
+        blocks.append(
+            ActionsBlock(elements=[
+                ButtonElement(text='すべて既読にする', action_id='mark_all_as_read', value='mark_all_as_read')
+            ]))
+    for item in items:
+        blocks += item_blocks(item.item_key, item.permalink)
+    # ビューのブロック数には上限があるため、続きは次のページに表示する
+    elements = []
+    if cursor is not None:
+        elements.append(ButtonElement(text='最初に戻る', action_id='home_page', value=FIRST_PAGE))
+    if next_cursor is not None:
+        elements.append(ButtonElement(text='次へ', action_id='home_page', value=next_cursor))
+    if elements:
+        blocks.append(ActionsBlock(elements=elements))
+    block_dicts = [block.to_dict() for block in blocks]
+    return {'type': 'home', 'blocks': block_dicts, 'private_metadata': fingerprint(block_dicts)}
+
+
+def get_view(team_id: str, user: str) -> Dict[str, Any]:
+    key = f'{team_id}:{user}'
+    view = home_view_cache.get(key)
+    if view is None:
+        view = render(team_id, user)
+        home_view_cache.set(key, view)
+    return view
+
+
+async def publish(team_conf: TeamConf, user: str, view: Dict[str, Any]):
+    from app.slack import get_client
+    client = get_client(team_conf.team_id, team_conf.access_token)
+    await client.views_publish(user_id=user, view=view)
+    home_published_cache.set(f'{team_conf.team_id}:{user}', view['private_metadata'])
+    metrics.incr('home.published')
+
+
+async def open_home(team_conf: TeamConf, user: str, published: Optional[str] = None):
+    """App Homeが開かれたときに一覧を表示する
+
+    publishedには表示されているビューのprivate_metadataを渡し、キャッシュしたビューと同じ場合は公開しない
+    """
+    view = get_view(team_conf.team_id, user)
+    if view['private_metadata'] == published:
+        home_published_cache.set(f'{team_conf.team_id}:{user}', view['private_metadata'])
+        metrics.incr('home.publish_skipped')
+        return
+    await publish(team_conf, user, view)
+
+
+async def show_page(team_conf: TeamConf, user: str, cursor: str):
+    """「次へ」「最初に戻る」が押されたページを表示する。キャッシュするのは1ページ目だけ"""
+    if cursor == FIRST_PAGE:
+        view = get_view(team_conf.team_id, user)
+    else:
+        view = render(team_conf.team_id, user, cursor)
+    await publish(team_conf, user, view)
+
+
+async def refresh(team_conf: TeamConf, user: str, publish_view: Optional[bool] = None):
+    """保存や既読で一覧が変わったときに呼び出す
+
+    キャッシュを捨て、常駐する場合はApp Homeを開いたことのあるユーザーだけ少し待ってから描画し直す。
+    待っている間の変更は1回の views.publish にまとめる。
+    Lambdaでは呼び出しが終わると待てないため、描画し直すのは次にApp Homeが開かれたときにする
+    """
+    key = f'{team_conf.team_id}:{user}'
+    home_view_cache.pop(key)
+    if publish_view is None:
+        publish_view = settings.LONG_RUNNING and key in home_published_cache
+    if not publish_view:
+        return
+    loop = asyncio.get_event_loop()
+    pending = _pending.get(key)
+    if pending is not None and not pending[0].done() and pending[0].get_loop() is loop:
+        metrics.incr('home.publish_coalesced')
+        return
+    flush = asyncio.Event()
+    task = loop.create_task(_publish_later(team_conf, user, flush))
+    _pending[key] = (task, flush)
+
+
+async def _publish_later(team_conf: TeamConf, user: str, flush: asyncio.Event):
+    try:
+        await asyncio.wait_for(flush.wait(), settings.HOME_PUBLISH_DELAY)
+    except asyncio.TimeoutError:
+        pass
+    # これ以降の変更は改めて描画し直す
+    _pending.pop(f'{team_conf.team_id}:{user}', None)
+    try:
+        await publish(team_conf, user, get_view(team_conf.team_id, user))
+    except Exception as e:
+        logger.error(e, exc_info=True)
+
+
+async def drain():
+    """待っている描画をすぐに行い、HOME_DRAIN_TIMEOUT秒まで終わるのを待つ"""
+    loop = asyncio.get_event_loop()
+    tasks = []
+    for task, flush in list(_pending.values()):
+        if task.get_loop() is loop:
+            flush.set()
+            tasks.append(task)
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=settings.HOME_DRAIN_TIMEOUT)
+    if pending:
+        logger.error('%d home views were not published before shutdown', len(pending))
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,30 @@
+"""プロセス内で集計するメトリクス
+
+計測中のリクエストやジョブがあれば、そのEMFのログにも出力する
+"""
+from collections import defaultdict
+from typing import DefaultDict, Dict
+
+from app import timing
+
+counters: DefaultDict[str, float] = defaultdict(float)
+gauges: Dict[str, float] = {}
+
+
+def incr(name: str, value: float = 1):
+    counters[name] += value
+    timing.count(name, value)
+
+
+def gauge(name: str, value: float):
+    gauges[name] = value
+    timing.record(name, value)
+
+
+def snapshot() -> Dict[str, float]:
+    return {**counters, **gauges}
+
+
+def reset():
+    counters.clear()
+    gauges.clear()
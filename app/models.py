@@ -1,23 +1,86 @@
-from typing import Any
+import asyncio
+import base64
+import contextvars
+import enum
+import hashlib
+import json
+from datetime import timedelta
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, FrozenSet, List, Optional, Sequence, Set, Tuple
 
-from cryptography.fernet import Fernet
-from pynamodb import attributes, models, types
+from pynamodb import attributes, indexes, models, types
+from pynamodb.constants import ALL_NEW
+from pynamodb.exceptions import PutError, UpdateError
+from pynamodb.expressions.condition import Condition
+from pynamodb.expressions.update import Action
+from pynamodb.settings import OperationSettings
 
+from app import timing
+from app.cache import TTLCache
+from app.singleflight import SingleFlight
 from app.datetime import now
 from app.settings import settings
 
+if TYPE_CHECKING:
+    from cryptography.fernet import MultiFernet
+
+# team_idをキーにTeamConfを保持するキャッシュ
+team_conf_cache: TTLCache[str, 'TeamConf'] = TTLCache(
+    'team_conf',
+    maxsize=settings.TEAM_CONF_CACHE_SIZE,
+    ttl=settings.TEAM_CONF_CACHE_TTL,
+)
+# キャッシュにないTeamConfの読み込みをteam_idごとにまとめる
+team_conf_flight: SingleFlight[str, 'TeamConf'] = SingleFlight('team_conf')
+# team_idをキーにTeamConfのemoji_setだけを保持するインデックス。保存したときとTTLで失効したときに更新する
+emoji_index: TTLCache[str, FrozenSet[str]] = TTLCache(
+    'emoji_index',
+    maxsize=settings.TEAM_CONF_CACHE_SIZE,
+    ttl=settings.EMOJI_INDEX_TTL,
+)
+emoji_index_flight: SingleFlight[str, FrozenSet[str]] = SingleFlight('emoji_index')
+# 暗号文のダイジェストをキーに復号した文字列を保持するキャッシュ
+plaintext_cache: TTLCache[bytes, str] = TTLCache('plaintext', maxsize=settings.TEAM_CONF_CACHE_SIZE)
+# 処理済みのevent_idを保持するキャッシュ
+processed_event_cache: TTLCache[str, bool] = TTLCache('processed_event', maxsize=4096, ttl=settings.EVENT_DEDUP_TTL)
+
+
+@lru_cache(maxsize=None)
+def get_fernet() -> 'MultiFernet':
+    """ENCRYPTION_KEYから暗号化に使うFernetを生成する
+
+    ENCRYPTION_KEYにはカンマ区切りで複数の鍵を指定できる。
+    暗号化には先頭の鍵を使い、復号はいずれかの鍵で行うため、鍵を入れ替える場合は先頭に新しい鍵を追加する。
+    古い鍵で暗号化された値は次に保存されたときに新しい鍵で暗号化し直される。
+    """
+    from cryptography.fernet import Fernet, MultiFernet
+
+    keys = [key.strip() for key in settings.ENCRYPTION_KEY.split(',') if key.strip()]
+    return MultiFernet([Fernet(key.encode('utf-8')) for key in keys])
+
 
 class EncryptedStringAttribute(attributes.Attribute):
     """文字列を暗号化して参照時に復号するAttribute"""
     attr_type = types.BINARY
 
     def serialize(self, value: str):
-        fernet = Fernet(settings.ENCRYPTION_KEY.encode('utf-8'))
-        return fernet.encrypt(value.encode('UTF-8'))
+        token = get_fernet().encrypt(value.encode('UTF-8'))
+        plaintext_cache.set(hashlib.sha256(token).digest(), value)
+        return token
 
     def deserialize(self, value):
-        fernet = Fernet(settings.ENCRYPTION_KEY.encode('utf-8'))
-        return fernet.decrypt(value).decode()
+        digest = hashlib.sha256(value).digest()
+        plaintext = plaintext_cache.get(digest)
+        if plaintext is None:
+            with timing.phase('decrypt'):
+                plaintext = get_fernet().decrypt(value).decode()
+            plaintext_cache.set(digest, plaintext)
+        return plaintext
+
+
+class DeliveryMode(str, enum.Enum):
+    IMMEDIATE = 'immediate'  # リアクションのたびにDMを送る
+    DIGEST = 'digest'  # 一定間隔でまとめてDMを送る
 
 
 class TeamConf(models.Model):
@@ -26,8 +89,360 @@ class TeamConf(models.Model):
     team_id = attributes.UnicodeAttribute(hash_key=True)  # Slackのワークスペースのteam_id
     access_token = EncryptedStringAttribute()
     emoji_set = attributes.UnicodeSetAttribute()  # SlackAppが反応するリアクションのemojiのset
+    url = attributes.UnicodeAttribute(null=True)  # ワークスペースのURL（例: https://example.slack.com/）
+    delivery_mode = attributes.UnicodeAttribute(null=True)  # DeliveryMode。未設定の場合はIMMEDIATE
     created_at = attributes.UTCDateTimeAttribute(default_for_new=now)
+    version = attributes.VersionAttribute()  # 楽観的ロックに使う。更新のたびに増える
 
     class Meta:
         region = 'ap-northeast-1'
+        host = settings.DYNAMODB_HOST
         table_name = settings.DYNAMODB_TABLE
+
+    @classmethod
+    def get(
+        cls,
+        hash_key: Any,
+        range_key: Optional[Any] = None,
+        consistent_read: bool = False,
+        attributes_to_get: Optional[Sequence[str]] = None,
+        settings: OperationSettings = OperationSettings.default,
+    ) -> 'TeamConf':
+        """キャッシュがあればDynamoDBに問い合わせずに返す
+
+        強い整合性での読み込みと一部の属性のみの読み込みはキャッシュを経由しない
+        """
+        if consistent_read or attributes_to_get:
+            return super().get(hash_key, range_key, consistent_read, attributes_to_get, settings)
+        team_conf = team_conf_cache.get(hash_key)
+        if team_conf is None:
+            with timing.phase('team_conf'):
+                team_conf = super().get(hash_key, range_key, settings=settings)
+            team_conf_cache.set(hash_key, team_conf)
+        return team_conf
+
+    @property
+    def is_digest(self) -> bool:
+        return self.delivery_mode == DeliveryMode.DIGEST
+
+    def cache(self, ttl: Optional[float] = None):
+        team_conf_cache.set(self.team_id, self, ttl)
+        emoji_index.set(self.team_id, frozenset(self.emoji_set or ()))
+
+    def uncache(self):
+        team_conf_cache.pop(self.team_id)
+        emoji_index.pop(self.team_id)
+
+    def save(self, *args, **kwargs) -> Dict[str, Any]:
+        try:
+            data = super().save(*args, **kwargs)
+        except Exception:
+            # 保存に失敗した場合はキャッシュとDBの内容が一致しないため破棄する
+            self.uncache()
+            raise
+        self.cache()
+        return data
+
+    def update(self, *args, **kwargs) -> Any:
+        try:
+            data = super().update(*args, **kwargs)
+        except Exception:
+            self.uncache()
+            raise
+        self.cache()
+        return data
+
+    def delete(self, *args, **kwargs) -> Any:
+        self.uncache()
+        return super().delete(*args, **kwargs)
+
+    def refresh(self, *args, **kwargs):
+        super().refresh(*args, **kwargs)
+        self.cache()
+
+    @classmethod
+    def upsert(cls, team_id: str, actions: Sequence[Action], condition: Optional[Condition] = None) -> 'TeamConf':
+        """項目がなければ作成し、あれば指定した属性だけを1回のUpdateItemで更新する
+
+        他の更新と競合しない属性だけを更新するため、versionは条件にせず増やすだけにする
+        """
+        try:
+            data = cls._get_connection().update_item(
+                team_id,
+                actions=[*actions, cls.version.add(1)],
+                condition=condition,
+                return_values=ALL_NEW,
+            )
+        except Exception:
+            team_conf_cache.pop(team_id)
+            emoji_index.pop(team_id)
+            raise
+        team_conf = cls.from_raw_data(data['Attributes'])
+        team_conf.cache()
+        return team_conf
+
+    def update_settings(self, emoji_set: Set[str], delivery_mode: Optional[DeliveryMode] = None):
+        """emoji_setとdelivery_modeだけを更新する
+
+        emoji_setは差分をADD/DELETEで更新する。読み込んだ後に別の更新があった場合はversionの条件で失敗するため、
+        DBから読み直して1回だけやり直す
+        """
+        for retry in (True, False):
+            current = self.emoji_set or set()
+            actions: List[Action] = []
+            if emoji_set - current:
+                actions.append(TeamConf.emoji_set.add(emoji_set - current))
+            if current - emoji_set:
+                actions.append(TeamConf.emoji_set.delete(current - emoji_set))
+            if delivery_mode is not None and self.delivery_mode != delivery_mode.value:
+                actions.append(TeamConf.delivery_mode.set(delivery_mode.value))
+            if not actions:
+                return
+            try:
+                self.update(actions=actions)
+                return
+            except UpdateError as e:
+                if not retry or e.cause_response_code != 'ConditionalCheckFailedException':
+                    raise
+            self.refresh(consistent_read=True)
+
+
+async def get_team_conf(team_id: str) -> 'TeamConf':
+    """TeamConf.getを非同期に呼び出す
+
+    キャッシュにない場合はイベントループを止めないよう別スレッドで読み込み、同じチームの同時の読み込みは1回にまとめる
+    """
+    team_conf = team_conf_cache.get(team_id)
+    if team_conf is not None:
+        return team_conf
+    loop = asyncio.get_event_loop()
+    # 処理時間を記録するため、呼び出し元のcontextvarsを引き継ぐ
+    context = contextvars.copy_context()
+    return await team_conf_flight.do(team_id, lambda: loop.run_in_executor(None, context.run, TeamConf.get, team_id))
+
+
+def load_emoji_index(team_id: str) -> FrozenSet[str]:
+    # アクセストークンを読み込まないため復号もしない
+    with timing.phase('emoji_index'):
+        team_conf = TeamConf.get(team_id, attributes_to_get=['emoji_set'])
+    emoji_set = frozenset(team_conf.emoji_set or ())
+    emoji_index.set(team_id, emoji_set)
+    return emoji_set
+
+
+async def get_emoji_index(team_id: str) -> FrozenSet[str]:
+    """チームが設定したemojiのsetを返す
+
+    設定されていないemojiのリアクションを、TeamConfを読み込んでアクセストークンを復号する前に無視するために使う
+    """
+    emoji_set = emoji_index.get(team_id)
+    if emoji_set is not None:
+        return emoji_set
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    return await emoji_index_flight.do(team_id,
+                                       lambda: loop.run_in_executor(None, context.run, load_emoji_index, team_id))
+
+
+class ProcessedEvent(models.Model):
+    """処理済みのSlackのイベント
+
+    Slackから再送されたイベントを重複して処理しないために記録する
+    """
+    event_id = attributes.UnicodeAttribute(hash_key=True)
+    expires_at = attributes.TTLAttribute()  # DynamoDBのTTLで自動的に削除される
+
+    class Meta:
+        region = 'ap-northeast-1'
+        host = settings.DYNAMODB_HOST
+        table_name = settings.DYNAMODB_EVENT_TABLE
+
+    @classmethod
+    def claim(cls, event_id: str) -> bool:
+        """イベントを処理済みとして記録する
+
+        既に処理済みの場合はFalseを返す
+        """
+        if event_id in processed_event_cache:
+            return False
+        try:
+            cls(event_id, expires_at=timedelta(seconds=settings.EVENT_DEDUP_TTL)).save(cls.event_id.does_not_exist())
+        except PutError as e:
+            if e.cause_response_code != 'ConditionalCheckFailedException':
+                raise
+            processed_event_cache.set(event_id, True)
+            return False
+        processed_event_cache.set(event_id, True)
+        return True
+
+
+class DigestItem(models.Model):
+    """まとめてDMで送るまで保存しておくメッセージ
+
+    同じユーザーが同じメッセージに複数回リアクションしても1件になる
+    """
+    team_user = attributes.UnicodeAttribute(hash_key=True)  # {team_id}:{user_id}
+    item_key = attributes.UnicodeAttribute(range_key=True)  # {channel}:{ts}
+    team_id = attributes.UnicodeAttribute()
+    user = attributes.UnicodeAttribute()
+    permalink = attributes.UnicodeAttribute()
+    created_at = attributes.UTCDateTimeAttribute(default_for_new=now)
+
+    class Meta:
+        region = 'ap-northeast-1'
+        host = settings.DYNAMODB_HOST
+        table_name = settings.DYNAMODB_DIGEST_TABLE
+
+    @classmethod
+    def create(cls, team_id: str, user: str, channel: str, ts: str, permalink: str) -> 'DigestItem':
+        item = cls(
+            f'{team_id}:{user}',
+            f'{channel}:{ts}',
+            team_id=team_id,
+            user=user,
+            permalink=permalink,
+        )
+        item.save()
+        return item
+
+
+class SavedItemKeyIndex(indexes.GlobalSecondaryIndex):
+    """元のメッセージから、保存したユーザーごとのSavedItemを引くためのインデックス"""
+    item_key = attributes.UnicodeAttribute(hash_key=True)  # {channel}:{ts}
+    team_user = attributes.UnicodeAttribute(range_key=True)  # {team_id}:{user_id}
+
+    class Meta:
+        index_name = 'item_key-index'
+        projection = indexes.IncludeProjection(['read_at'])
+
+
+class SavedItemUnreadIndex(indexes.GlobalSecondaryIndex):
+    """未読のSavedItemだけを保存した日時の順に並べるインデックス
+
+    既読にするとunread_saved_atを削除し、インデックスから外す
+    """
+    team_user = attributes.UnicodeAttribute(hash_key=True)
+    unread_saved_at = attributes.UTCDateTimeAttribute(range_key=True)
+
+    class Meta:
+        index_name = 'unread-index'
+        projection = indexes.AllProjection()
+
+
+class SavedItem(models.Model):
+    """リアクションして保存したメッセージ
+
+    ユーザーごとに保存した日時の順に並べ、元のメッセージ（channelとts）からもインデックスで引けるようにする
+    """
+    team_user = attributes.UnicodeAttribute(hash_key=True)  # {team_id}:{user_id}
+    saved_at = attributes.UTCDateTimeAttribute(range_key=True, default_for_new=now)
+    item_key = attributes.UnicodeAttribute()  # {channel}:{ts}
+    team_id = attributes.UnicodeAttribute()
+    user = attributes.UnicodeAttribute()
+    channel = attributes.UnicodeAttribute()
+    ts = attributes.UnicodeAttribute()
+    permalink = attributes.UnicodeAttribute()
+    read_at = attributes.UTCDateTimeAttribute(null=True)  # 読んだ日時。未読の場合はNone
+    unread_saved_at = attributes.UTCDateTimeAttribute(null=True)  # 未読の場合だけsaved_atと同じ値を持つ
+    item_key_index = SavedItemKeyIndex()
+    unread_index = SavedItemUnreadIndex()
+
+    class Meta:
+        region = 'ap-northeast-1'
+        host = settings.DYNAMODB_HOST
+        table_name = settings.DYNAMODB_SAVED_TABLE
+        billing_mode = 'PAY_PER_REQUEST'
+
+    @property
+    def is_read(self) -> bool:
+        return self.read_at is not None
+
+    @classmethod
+    def find(cls, team_id: str, user: str, item_key: str) -> List['SavedItem']:
+        """ユーザーが保存したメッセージをインデックスで引く
+
+        インデックスにはキーとread_atしか含まれない
+        """
+        return list(cls.item_key_index.query(item_key, cls.team_user == f'{team_id}:{user}'))
+
+    @classmethod
+    def create(cls, team_id: str, user: str, channel: str, ts: str, permalink: str) -> 'SavedItem':
+        """メッセージを保存する
+
+        未読のまま同じメッセージに再びリアクションした場合は保存し直さない
+        """
+        item_key = f'{channel}:{ts}'
+        for saved in cls.find(team_id, user, item_key):
+            if not saved.is_read:
+                return saved
+        saved_at = now()
+        item = cls(
+            f'{team_id}:{user}',
+            saved_at,
+            unread_saved_at=saved_at,
+            item_key=item_key,
+            team_id=team_id,
+            user=user,
+            channel=channel,
+            ts=ts,
+            permalink=permalink,
+        )
+        item.save()
+        return item
+
+    @classmethod
+    def mark_as_read(cls, team_id: str, user: str, item_key: str) -> int:
+        """保存したメッセージを既読にして、既読にした件数を返す"""
+        count = 0
+        for saved in cls.find(team_id, user, item_key):
+            if not saved.is_read:
+                saved.update(actions=[cls.read_at.set(now()), cls.unread_saved_at.remove()])
+                count += 1
+        return count
+
+    @classmethod
+    def mark_all_as_read(cls, team_id: str, user: str) -> int:
+        """未読のメッセージをすべて既読にして、既読にした件数を返す"""
+        count = 0
+        read_at = now()
+        for saved in cls.unread_index.query(f'{team_id}:{user}'):
+            saved.update(actions=[cls.read_at.set(read_at), cls.unread_saved_at.remove()])
+            count += 1
+        return count
+
+    @classmethod
+    def page(cls, team_id: str, user: str, limit: int = 20, cursor: Optional[str] = None,
+             unread: bool = False) -> Tuple[List['SavedItem'], Optional[str]]:
+        """ユーザーが保存したメッセージを新しい順に返す
+
+        続きがある場合は次のページのcursorも返す。unreadを指定した場合は未読のものだけをインデックスから返す
+        """
+        query = cls.unread_index.query if unread else cls.query
+        # 続きがあるか判定するため1件多く読む
+        results = query(
+            f'{team_id}:{user}',
+            scan_index_forward=False,
+            page_size=limit + 1,
+            last_evaluated_key=decode_cursor(cursor),
+        )
+        items: List['SavedItem'] = []
+        last_evaluated_key = None
+        for item in results:
+            if len(items) == limit:
+                return items, encode_cursor(last_evaluated_key)
+            items.append(item)
+            last_evaluated_key = results.last_evaluated_key
+        return items, None
+
+
+def encode_cursor(last_evaluated_key: Optional[Dict[str, Any]]) -> Optional[str]:
+    """DynamoDBのLastEvaluatedKeyをページの続きを指すcursorにする"""
+    if not last_evaluated_key:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not cursor:
+        return None
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
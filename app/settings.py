@@ -1,15 +1,52 @@
 from os import environ
+from typing import Optional
+
 from pydantic import BaseSettings
 
 
 class Settings(BaseSettings):
     ENVIRONMENT_NAME: str = environ['ENVIRONMENT_NAME']
     DYNAMODB_TABLE: str = environ['DYNAMODB_TABLE']
+    DYNAMODB_EVENT_TABLE: str = environ.get('DYNAMODB_EVENT_TABLE', f"{environ['DYNAMODB_TABLE']}-events")
+    DYNAMODB_HOST: Optional[str] = None  # DynamoDB LocalなどAWS以外のDynamoDBに接続する場合に指定する
+    DYNAMODB_DIGEST_TABLE: str = environ.get('DYNAMODB_DIGEST_TABLE', f"{environ['DYNAMODB_TABLE']}-digest")
+    DYNAMODB_SAVED_TABLE: str = environ.get('DYNAMODB_SAVED_TABLE', f"{environ['DYNAMODB_TABLE']}-saved")
     SENTRY_DNS: str = environ['SENTRY_DNS']
     SLACK_SIGNING_SECRET: str = environ['SLACK_SIGNING_SECRET']
     SLACK_CLIENT_ID: str = environ['SLACK_CLIENT_ID']
     SLACK_CLIENT_SECRET = environ['SLACK_CLIENT_SECRET']
-    ENCRYPTION_KEY = environ['ENCRYPTION_KEY']
+    ENCRYPTION_KEY = environ['ENCRYPTION_KEY']  # カンマ区切りで複数指定した場合は先頭の鍵で暗号化する
+    TEAM_CONF_CACHE_TTL: float = 60  # TeamConfをプロセス内にキャッシュする秒数
+    TEAM_CONF_CACHE_SIZE: int = 1024
+    EMOJI_INDEX_TTL: float = 60  # チームが設定したemojiのsetをプロセス内にキャッシュする秒数
+    WORKER_CONCURRENCY: int = 4  # レスポンス後の処理を並行して実行する数
+    WORKER_QUEUE_SIZE: int = 100
+    WORKER_DRAIN_TIMEOUT: float = 15  # 終了時に残っているジョブの処理を待つ秒数
+    EVENT_FUNCTION: Optional[str] = None  # レスポンスを返した後の処理を任せるLambda関数。指定しない場合はワーカーで処理する
+    EVENT_DEDUP_TTL: int = 60 * 60  # 処理済みのイベントを記録しておく秒数
+    DIGEST_MAX_ITEMS: int = 20  # まとめて送るDM1通あたりのメッセージ数（Block Kitのブロック数の上限は50）
+    HOME_PAGE_SIZE: int = 20  # App Homeの1ページに表示するメッセージ数（ビューのブロック数の上限は100）
+    HOME_VIEW_CACHE_TTL: float = 60  # App Homeのビューをプロセス内にキャッシュする秒数
+    HOME_VIEW_CACHE_SIZE: int = 1024
+    HOME_ACTIVE_TTL: float = 60 * 60  # App Homeを開いてからこの秒数の間は、一覧が変わったときに描画し直す
+    HOME_DRAIN_TIMEOUT: float = 5  # 終了時に待っている描画を待つ秒数
+    HOME_PUBLISH_DELAY: float = 5  # 一覧が変わってからApp Homeを描画し直すまで待ち、その間の変更をまとめる秒数
+    MARK_ALL_FUNCTION: Optional[str] = None  # まとめて既読にする処理を任せるLambda関数。指定しない場合はワーカーで処理する
+    MARK_ALL_CONCURRENCY: int = 3  # まとめて既読にする際にchat.deleteを並行して呼び出す数
+    MARK_ALL_PAGE_SIZE: int = 20  # conversations.historyで1回に読むメッセージ数
+    MARK_ALL_MIN_REMAINING: float = 60  # Lambdaの残り秒数がこれを下回ったら続きを別の呼び出しに任せる
+    METRICS_NAMESPACE: str = 'atodeyomu'  # EMFで出力するメトリクスの名前空間
+    LONG_RUNNING: bool = False  # コンテナなどプロセスが常駐する場合に指定し、起動時にキャッシュと接続を温める
+    WARM_UP_CUSTOM_EMOJI: bool = False  # 起動時にカスタムemojiも読み込む
+    WARM_UP_LIMIT: int = 100  # 温めるときにScanで読み込むTeamConfの最大数
+    WARM_UP_TTL: float = 6 * 60  # 温めたTeamConfをキャッシュする秒数。serverless.ymlのスケジュールの間隔より長くする
+    TIMING_LOG: bool = True  # リクエストごとの処理時間をEMFで出力する
+    SLACK_API_URL: str = 'https://www.slack.com/api/'
+    SLACK_APP_TOKEN: Optional[str] = None  # Socket Modeで接続するためのApp-Level Token（xapp-）
+    SLACK_MAX_RETRIES: int = 3  # Slack APIがHTTP 429を返した場合に再試行する回数
+    SLACK_ACK_TIMEOUT: float = 2.5  # Slackに応答を返すまでの秒数。これを超えてレート制限を待つ場合は待たずに失敗させる
+    CUSTOM_EMOJI_CACHE_TTL: float = 60 * 60  # emoji_changedイベントを取りこぼした場合に備えてカスタムemojiを取り直す間隔
+    CUSTOM_EMOJI_REFETCH_INTERVAL: float = 30  # 見つからないカスタムemojiがあった場合にemoji.listを呼び出し直す最短の間隔
 
 
 settings = Settings()
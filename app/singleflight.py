@@ -0,0 +1,50 @@
+"""同じキーに対する同時の問い合わせを1回にまとめる
+
+人気のあるメッセージに同じリアクションがまとめて付いた場合などに、
+同じTeamConfの読み込みや同じメッセージのchat.getPermalinkが並行して呼ばれても、DynamoDBやSlack APIへの問い合わせは1回にする。
+結果はキャッシュせず、問い合わせが終わるまでの間だけ共有する。
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, Generic, Hashable, TypeVar
+
+from app import metrics
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class SingleFlight(Generic[K, V]):
+    """同じキーで実行中の問い合わせがあれば、その結果を待って返す"""
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[K, 'asyncio.Future[V]'] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: K, func: Callable[[], Awaitable[V]]) -> V:
+        loop = asyncio.get_event_loop()
+        future = self._calls.get(key)
+        if future is not None and future.get_loop() is loop:
+            metrics.incr(f'singleflight.{self.name}.coalesced')
+            # 待っている呼び出しがキャンセルされても、実行中の問い合わせは止めない
+            return await asyncio.shield(future)
+        future = loop.create_future()
+        self._calls[key] = future
+        metrics.incr(f'singleflight.{self.name}.calls')
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 待っている呼び出しがなくても、例外が取り出されなかったという警告を出さない
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._calls.get(key) is future:
+                del self._calls[key]
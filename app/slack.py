@@ -0,0 +1,258 @@
+"""Slack Web APIのクライアント
+
+aiohttpのセッションをプロセス内で共有し、Lambdaのコンテナが再利用される間はHTTPSの接続を使い回す。
+APIの呼び出しはチームとメソッドごとのトークンバケットでレート制限の範囲に収める。
+レート制限で待つのはレスポンスを返した後の処理だけにし、Slackに応答を返す前の処理では待たずにRateLimitExceededを送出する。
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from typing import Any, DefaultDict, Dict, Optional, Tuple
+
+import aiohttp
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk.web.async_slack_response import AsyncSlackResponse
+
+from app import metrics, timing
+from app.cache import TTLCache
+from app.singleflight import SingleFlight
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# メソッドごとの1分あたりの呼び出し回数の上限
+# ref: https://api.slack.com/docs/rate-limits
+RATE_LIMITS: Dict[str, int] = {
+    'auth.test': 100,
+    'chat.delete': 50,  # Tier 3
+    'chat.getPermalink': 100,  # Tier 4
+    'chat.postMessage': 60,  # Special: チャンネルごとに1秒に1回
+    'chat.update': 50,  # Tier 3
+    'emoji.list': 20,  # Tier 2
+    'views.open': 100,  # Tier 4
+    'views.publish': 100,  # Tier 4
+}
+# チャンネルごとにレート制限されるメソッド
+PER_CHANNEL_METHODS = {'chat.postMessage'}
+# 続けて呼び出せる回数。指定しないメソッドはBURST_SECONDS秒分
+BURSTS: Dict[str, int] = {
+    'chat.postMessage': 1,
+}
+BURST_SECONDS = 3
+
+
+class RateLimitExceeded(Exception):
+    """Slackに応答を返すまでにレート制限が解除されない"""
+    def __init__(self, delay: float):
+        super().__init__(f'rate limited for {delay:.1f} seconds')
+        self.delay = delay
+
+
+class TokenBucket:
+    """一定の速度でトークンが補充され、トークンがない間は待たされるバケット
+
+    capacityを超えては溜まらないため、しばらく呼び出しがなくても続けて呼び出せるのはcapacity回まで
+    """
+    def __init__(self, per_minute: int, capacity: Optional[float] = None):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * BURST_SECONDS) if capacity is None else float(capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    async def acquire(self, max_wait: Optional[float] = None) -> float:
+        """トークンを1つ取得する
+
+        待った秒数を返す。max_waitを超えて待つ必要がある場合は待たずにRateLimitExceededを送出する
+        """
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                delay = self.blocked_until - now
+            elif self.tokens >= 1:
+                self.tokens -= 1
+                return waited
+            else:
+                delay = (1 - self.tokens) / self.rate
+            if max_wait is not None and waited + delay > max_wait:
+                raise RateLimitExceeded(delay)
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def block(self, seconds: float):
+        """Retry-Afterで指定された秒数だけ呼び出しを止める
+
+        止めている間はトークンを補充せず、再開後は1回だけ呼び出せる
+        """
+        self.tokens = 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.updated_at = self.blocked_until
+
+
+# (team_id, メソッド, チャンネル)をキーにトークンバケットを保持する
+rate_limit_buckets: TTLCache[Tuple[str, str, Optional[str]], TokenBucket] = TTLCache('rate_limit', maxsize=4096)
+
+
+def get_bucket(team_id: str, api_method: str, channel: Optional[str] = None) -> Optional[TokenBucket]:
+    if api_method not in RATE_LIMITS:
+        return None
+    key = (team_id, api_method, channel if api_method in PER_CHANNEL_METHODS else None)
+    bucket = rate_limit_buckets.get(key)
+    if bucket is None:
+        bucket = TokenBucket(RATE_LIMITS[api_method], BURSTS.get(api_method))
+        rate_limit_buckets.set(key, bucket)
+    return bucket
+
+
+# メソッドごとのレート制限で待たされている呼び出しの数
+waiting: DefaultDict[str, int] = defaultdict(int)
+
+
+class RateLimitedAsyncWebClient(AsyncWebClient):
+    """レート制限を超えないように呼び出しを待たせ、HTTP 429が返された場合はRetry-Afterだけ待って再試行するクライアント"""
+    def __init__(self, *args, rate_limit_key: Optional[str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limit_key = rate_limit_key
+
+    async def api_call(self, api_method: str, **kwargs) -> AsyncSlackResponse:  # type: ignore[override]
+        with timing.phase(f'slack.{api_method}'):
+            return await self._api_call(api_method, **kwargs)
+
+    async def _api_call(self, api_method: str, **kwargs) -> AsyncSlackResponse:
+        if self.rate_limit_key is None:
+            return await super().api_call(api_method, **kwargs)
+        bucket = get_bucket(self.rate_limit_key, api_method, _channel(kwargs))
+        for attempt in range(settings.SLACK_MAX_RETRIES + 1):
+            if bucket is not None:
+                waiting[api_method] += 1
+                metrics.gauge(f'slack.{api_method}.queue_depth', waiting[api_method])
+                try:
+                    waited = await bucket.acquire(timing.remaining())
+                except RateLimitExceeded:
+                    metrics.incr(f'slack.{api_method}.rejected')
+                    raise
+                finally:
+                    waiting[api_method] -= 1
+                if waited:
+                    metrics.incr(f'slack.{api_method}.wait_seconds', waited)
+            try:
+                return await super().api_call(api_method, **kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt == settings.SLACK_MAX_RETRIES:
+                    raise
+                retry_after = float(e.response.headers.get('Retry-After', 1))
+                metrics.incr(f'slack.{api_method}.rate_limited')
+                logger.warning('%s is rate limited. retry after %s seconds', api_method, retry_after)
+                if bucket is not None:
+                    bucket.block(retry_after)
+                remaining = timing.remaining()
+                if remaining is not None and retry_after > remaining:
+                    # Slackに応答を返す前の処理では、応答が遅れて再送されるより失敗させる
+                    raise
+                if bucket is None:
+                    await asyncio.sleep(retry_after)
+        raise AssertionError('unreachable')  # pragma: no cover
+
+
+def _channel(kwargs: Dict[str, Any]) -> Optional[str]:
+    for key in ('json', 'params', 'data'):
+        value = kwargs.get(key)
+        if isinstance(value, dict) and value.get('channel'):
+            return value['channel']
+    return None
+
+
+# team_idをキーにクライアントを保持する
+client_pool: TTLCache[str, RateLimitedAsyncWebClient] = TTLCache('slack_client', maxsize=1024)
+# (team_id, channel, ts)をキーにchat.getPermalinkで取得したパーマリンクを保持する
+permalink_cache: TTLCache[Tuple[str, str, str], str] = TTLCache('permalink', maxsize=4096)
+permalink_flight: SingleFlight[Tuple[str, str, str], str] = SingleFlight('permalink')
+
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """実行中のイベントループで共有するセッションを返す"""
+    global _session, _session_loop
+    loop = asyncio.get_event_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(limit=100, keepalive_timeout=60)
+        _session = aiohttp.ClientSession(connector=connector)
+        _session_loop = loop
+    return _session
+
+
+async def close_session():
+    global _session, _session_loop
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    _session_loop = None
+    client_pool.clear()
+
+
+def get_client(team_id: Optional[str] = None, token: Optional[str] = None) -> RateLimitedAsyncWebClient:
+    """共有セッションを使うクライアントを返す
+
+    team_idを指定した場合はチームごとにクライアントを使い回し、チームごとにレート制限する
+    """
+    session = get_session()
+    if team_id is None:
+        return RateLimitedAsyncWebClient(token, base_url=settings.SLACK_API_URL, session=session)
+    client = client_pool.get(team_id)
+    if client is None or client.session is not session or client.token != token:
+        client = RateLimitedAsyncWebClient(
+            token,
+            base_url=settings.SLACK_API_URL,
+            session=session,
+            rate_limit_key=team_id,
+        )
+        client_pool.set(team_id, client)
+    return client
+
+
+def build_permalink(workspace_url: str, channel: str, ts: str) -> str:
+    """ワークスペースのURLからメッセージのパーマリンクを組み立てる
+
+    >>> build_permalink('https://example.slack.com/', 'C0000000000', '1629891004.013500')
+    'https://example.slack.com/archives/C0000000000/p1629891004013500'
+    """
+    return f"{workspace_url.rstrip('/')}/archives/{channel}/p{ts.replace('.', '')}"
+
+
+def workspace_url_from_permalink(permalink: str) -> Optional[str]:
+    """パーマリンクからワークスペースのURLを取り出す"""
+    url, separator, _ = permalink.partition('/archives/')
+    return f'{url}/' if separator else None
+
+
+async def get_permalink(client: AsyncWebClient, team_id: str, workspace_url: Optional[str], channel: str,
+                        ts: str) -> str:
+    """メッセージのパーマリンクを返す
+
+    ワークスペースのURLがわからない場合だけchat.getPermalinkを呼び出す
+    """
+    if workspace_url:
+        return build_permalink(workspace_url, channel, ts)
+    key = (team_id, channel, ts)
+    permalink = permalink_cache.get(key)
+    if permalink is None:
+        permalink = await permalink_flight.do(key, lambda: _get_permalink(client, key))
+    return permalink
+
+
+async def _get_permalink(client: AsyncWebClient, key: Tuple[str, str, str]) -> str:
+    _, channel, ts = key
+    permalink = (await client.chat_getPermalink(channel=channel, message_ts=ts)).get('permalink')
+    permalink_cache.set(key, permalink)
+    return permalink
@@ -0,0 +1,88 @@
+"""Socket ModeでSlackに接続して常駐するエントリーポイント
+
+API Gateway + Lambdaの代わりに1つのプロセスでWebSocketからイベントを受け取り、/v1 と同じ処理を呼び出す。
+1つのイベントループで複数のenvelopeを並行して処理し、キャッシュやSlack APIの接続はプロセスが生きている間使い回す。
+ref: https://api.slack.com/apis/connections/socket
+
+    $ SLACK_APP_TOKEN=xapp-... python -m app.socket_mode
+"""
+import asyncio
+import logging
+import signal
+from typing import Any, Optional
+
+from pydantic import ValidationError
+from slack_sdk.socket_mode.aiohttp import SocketModeClient
+from slack_sdk.socket_mode.async_client import AsyncBaseSocketModeClient
+from slack_sdk.socket_mode.request import SocketModeRequest
+from slack_sdk.socket_mode.response import SocketModeResponse
+
+from app import home, timing, worker
+from app.settings import settings
+from app.slack import close_session, get_client
+from app.v1.actions import dispatch
+from app.v1.events import EventCallback, handle_event
+
+logger = logging.getLogger(__name__)
+
+
+async def handle_request(client: AsyncBaseSocketModeClient, request: SocketModeRequest) -> None:
+    """envelopeを処理して受け取ったことをSlackに返す"""
+    # interactiveは処理の結果を応答として返すため、HTTPと同じくSlackに応答を返すまでの期限を設ける
+    deadline = settings.SLACK_ACK_TIMEOUT if request.type == 'interactive' else None
+    with timing.measure(f'socket_mode.{request.type}', deadline):
+        if request.type == 'events_api':
+            # HTTPと同様に、処理を終える前に受け取ったことを返してSlackの再送を避ける
+            await client.send_socket_mode_response(SocketModeResponse(request.envelope_id))
+            try:
+                event = EventCallback.parse_obj(request.payload)
+            except ValidationError as e:
+                logger.warning('invalid event: %s', e)
+                timing.set_outcome('rejected')
+                return
+            await handle_event(event, request.retry_attempt)
+        elif request.type == 'interactive':
+            # view_submissionのエラーなど、処理の結果をenvelopeの応答として返す
+            result = await dispatch(request.payload)
+            await client.send_socket_mode_response(SocketModeResponse(request.envelope_id, payload=_payload(result)))
+        else:
+            await client.send_socket_mode_response(SocketModeResponse(request.envelope_id))
+            timing.set_outcome('ignored')
+
+
+def _payload(result: Any) -> Optional[dict]:
+    return result if isinstance(result, dict) else None
+
+
+async def run(stop: asyncio.Event):
+    """stopがセットされるまでSocket Modeで接続し、終了時にキューに残った処理を終える"""
+    if not settings.SLACK_APP_TOKEN:
+        raise SystemExit('SLACK_APP_TOKEN is required to connect with Socket Mode')
+    client = SocketModeClient(settings.SLACK_APP_TOKEN, web_client=get_client())
+    client.socket_mode_request_listeners.append(handle_request)
+    try:
+        await client.connect()
+        logger.info('connected with Socket Mode')
+        await stop.wait()
+    finally:
+        await client.close()
+        await worker.drain()
+        await home.drain()
+        await close_session()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        loop.run_until_complete(run(stop))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
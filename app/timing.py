@@ -0,0 +1,200 @@
+"""リクエストの処理にかかった時間をフェーズごとに計測する
+
+    with timing.phase('team_conf'):
+        team_conf = TeamConf.get(team_id)
+
+計測した時間はServer-Timingヘッダーと、CloudWatchのEmbedded Metric Format（EMF）のJSONとして
+リクエストごとに1行ずつ標準出力に書き出す。EMFにはその間にapp.metricsで記録したカウンターとゲージも含める。
+Lambdaのloggingは行頭にログレベルなどを付けてEMFとして解釈されなくなるため、loggingは使わない。
+ref: https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+"""
+import json
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional
+
+from app.settings import settings
+
+
+class Timing:
+    """1つのリクエストまたはジョブで計測した時間
+
+    deadlineにはSlackに応答を返すまでの秒数を指定する。Slack APIのレート制限で待つかどうかの判断に使う
+    """
+    def __init__(self, operation: str, deadline: Optional[float] = None):
+        self.operation = operation
+        self.started_at = time.perf_counter()
+        self.deadline = deadline
+        self.phases: Dict[str, float] = {}
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.team_id: Optional[str] = None
+        self.outcome: Optional[str] = None
+
+    def add(self, name: str, seconds: float):
+        """フェーズの時間をミリ秒で加算する。同じフェーズを複数回通った場合は合計する"""
+        self.phases[name] = self.phases.get(name, 0.0) + seconds * 1000
+
+    @property
+    def total(self) -> float:
+        return (time.perf_counter() - self.started_at) * 1000
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return self.started_at + self.deadline - time.perf_counter()
+
+    def server_timing(self) -> str:
+        """Server-Timingヘッダーの値
+
+        ref: https://www.w3.org/TR/server-timing/
+        """
+        metrics = [*self.phases.items(), ('total', self.total)]
+        return ', '.join(f'{name};dur={duration:.2f}' for name, duration in metrics)
+
+    def emf(self, **properties: Any) -> Dict[str, Any]:
+        """EMFのログ
+
+        チームごとに集計するとメトリクスが増えすぎるため、team_idはディメンションにせずプロパティとして残す
+        """
+        values = {name: round(duration, 3) for name, duration in self.phases.items()}
+        values['total'] = round(self.total, 3)
+        units = {name: 'Milliseconds' for name in values}
+        for name, value in [*self.counters.items(), *self.gauges.items()]:
+            values[name] = round(value, 3)
+            units[name] = 'Seconds' if name.endswith('_seconds') else 'Count'
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': settings.METRICS_NAMESPACE,
+                    'Dimensions': [['operation']],
+                    'Metrics': [{
+                        'Name': name,
+                        'Unit': unit
+                    } for name, unit in units.items()],
+                }],
+            },
+            'operation': self.operation,
+            **values,
+            'team_id': self.team_id,
+            'outcome': self.outcome,
+            **properties,
+        }
+
+    def emit(self, **properties: Any):
+        if not settings.TIMING_LOG:
+            return
+        sys.stdout.write(json.dumps(self.emf(**properties), ensure_ascii=False) + '\n')
+
+
+_current: ContextVar[Optional[Timing]] = ContextVar('timing', default=None)
+
+
+def current() -> Optional[Timing]:
+    return _current.get()
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """ブロックの実行にかかった時間を計測中のリクエストに記録する"""
+    timing = _current.get()
+    if timing is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, time.perf_counter() - started_at)
+
+
+def count(name: str, value: float = 1):
+    """計測中のリクエストのカウンターに加算する"""
+    timing = _current.get()
+    if timing is not None:
+        timing.counters[name] = timing.counters.get(name, 0) + value
+
+
+def record(name: str, value: float):
+    """計測中のリクエストのゲージを記録する。最後に記録した値を出力する"""
+    timing = _current.get()
+    if timing is not None:
+        timing.gauges[name] = value
+
+
+def remaining() -> Optional[float]:
+    """Slackに応答を返すまでの残り秒数。レスポンスを返した後の処理など、期限がなければNone"""
+    timing = _current.get()
+    return None if timing is None else timing.remaining()
+
+
+def set_team(team_id: Optional[str]):
+    timing = _current.get()
+    if timing is not None:
+        timing.team_id = team_id
+
+
+def set_outcome(outcome: str):
+    timing = _current.get()
+    if timing is not None:
+        timing.outcome = outcome
+
+
+@contextmanager
+def measure(operation: str, deadline: Optional[float] = None) -> Iterator[Timing]:
+    """リクエスト以外の処理（ワーカーのジョブなど）を計測してEMFのログを書き出す"""
+    timing = Timing(operation, deadline)
+    token = _current.set(timing)
+    try:
+        yield timing
+    except Exception:
+        timing.outcome = 'error'
+        raise
+    finally:
+        _current.reset(token)
+        timing.outcome = timing.outcome or 'ok'
+        timing.emit()
+
+
+def outcome_from_status(status: int) -> str:
+    if status >= 500:
+        return 'error'
+    if status >= 400:
+        return 'rejected'
+    return 'ok'
+
+
+class TimingMiddleware:
+    """リクエストごとに計測を始め、Server-Timingヘッダーを付けてEMFのログを書き出すASGIミドルウェア"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timing = Timing(scope['path'], settings.SLACK_ACK_TIMEOUT)
+        token = _current.set(timing)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', timing.server_timing().encode('latin-1')))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            if status == 404:
+                # 存在しないパスごとにメトリクスが増えないようにまとめる
+                timing.operation = 'not_found'
+            timing.outcome = timing.outcome or outcome_from_status(status)
+            timing.emit(status=status)
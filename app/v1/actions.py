@@ -2,21 +2,18 @@
 SlackからのInteractiveActionsリクエストを処理する
 """
 import enum
-import emoji
 import logging
 from http import HTTPStatus
-from typing import Dict, List, Optional
-
-from fastapi import APIRouter, Request, Response, Depends
-from fastapi.responses import RedirectResponse
-from pydantic import BaseModel, parse_raw_as
-from sentry_sdk.integrations.serverless import serverless_function
-from slack_sdk import WebClient
-from slack_sdk.models.blocks.basic_components import DispatchActionConfig
-from slack_sdk.models.views import View
-from slack_sdk.models.blocks import ActionsBlock, CheckboxesElement, InputBlock, Option, PlainTextInputElement
-from app.dependencies import verify_signature
-from app.models import TeamConf
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from typing import Type as TypingType
+
+from fastapi import APIRouter, Response, Depends
+from pydantic import BaseModel
+from app import bulk, home, timing
+from app.dependencies import slack_payload, verify_signature
+from app.digest import has_item_blocks, remove_item_blocks
+from app.emojis import get_custom_emoji, is_unicode_emoji, normalize
+from app.models import DeliveryMode, SavedItem, TeamConf, get_team_conf
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix='/actions')
@@ -94,129 +91,195 @@ class Payload(BaseModel):
         return self.type == Type.BLOCK_ACTIONS
 
 
+class ActionMessage(BaseModel):
+    ts: str
+    # メッセージのブロックは大きく、chat.updateにそのまま渡すため要素ごとには検証しない
+    blocks: list = []
+
+
 class ButtonActionPayload(Payload):
     actions: List[Action]
+    message: Optional[ActionMessage]
 
 
 class ViewSubmissionPayload(Payload):
     view: ActionView
 
 
-@serverless_function
-@router.post('/', status_code=HTTPStatus.OK, dependencies=[Depends(verify_signature)])
-async def actions(request: Request):
-    form = await request.form()
-    payload: Payload = parse_raw_as(Payload, form['payload'])
-    if payload.is_view_submission:
-        # モーダルに入力した内容を送信するイベント
-        return RedirectResponse('./view_submission/')
-    if payload.is_shortcut:
-        # ショートカット（「emojiを追加」「emojiを編集」）を選択したイベント
-        return RedirectResponse('./shortcuts/')
-    if payload.is_block_actions:
-        if payload.container:
-            if payload.container.is_message:
-                # 「読んだ」ボタンを押したイベント
-                return RedirectResponse('./message/')
-    return Response()
-
-
-@router.post(
-    '/shortcuts/',
-    name='actions_shortcuts',
-    status_code=HTTPStatus.OK,
-    dependencies=[Depends(verify_signature)],
-)
-async def shortcuts(request: Request):
-    form = await request.form()
-    payload = Payload.parse_raw(form['payload'])
+Handler = Callable[[Any, TeamConf], Awaitable[Any]]
+# (payloadのtype, callback_idまたはaction_id)をキーにした処理の対応表
+handlers: Dict[Tuple[Type, str], Tuple[Handler, TypingType[Payload]]] = {}
+
+
+def handler(type: Type, key: str, payload_class: TypingType[Payload]):
+    """payloadのtypeとcallback_idまたはaction_idに対応する処理を登録する"""
+    def decorator(func: Handler) -> Handler:
+        handlers[(type, key)] = (func, payload_class)
+        return func
+
+    return decorator
+
+
+def routing_key(data: dict) -> Optional[Tuple[Type, str]]:
+    type = data.get('type')
+    if type == Type.SHORTCUT:
+        key = data.get('callback_id')
+    elif type == Type.VIEW_SUBMISSION:
+        key = data.get('view', {}).get('callback_id')
+    elif type == Type.BLOCK_ACTIONS:
+        actions = data.get('actions') or [{}]
+        key = actions[0].get('action_id')
+    else:
+        return None
+    if key is None:
+        return None
+    return Type(type), key
+
+
+async def dispatch(data: dict) -> Any:
+    """payloadに対応する処理を呼び出す"""
+    key = routing_key(data)
+    if key is None or key not in handlers:
+        return Response()
+    func, payload_class = handlers[key]
+    payload = payload_class.parse_obj(data)
+    timing.set_team(payload.team.id)
     try:
-        team_conf = TeamConf.get(payload.team.id)
+        team_conf = await get_team_conf(payload.team.id)
     except TeamConf.DoesNotExist:
         return Response(status_code=HTTPStatus.BAD_REQUEST)
-    client = WebClient(team_conf.access_token)
-    if payload.callback_id == 'edit_emoji_set':
-        emoji_set = team_conf.emoji_set
-        # 登録できるemojiは3つまで
-        if emoji_set is None:
-            emoji_count = 0
-            external_input = 3
-            blocks = []
-        else:
-            emoji_count = len(emoji_set)
-            external_input = 3 - emoji_count
-            blocks = [
-                InputBlock(
-                    block_id=f'emoji_{index}',
-                    label=f':{item}:',
-                    element=PlainTextInputElement(
-                        action_id=f'emoji_{index}',
-                        initial_value=item,
-                        placeholder=':atodeyomu:',
-                    ),
-                    optional=True,
-                ) for index, item in enumerate(emoji_set)
-            ]
-        blocks += [
+    return await func(payload, team_conf)
+
+
+@router.post('/', status_code=HTTPStatus.OK, dependencies=[Depends(verify_signature)])
+async def actions(payload: dict = Depends(slack_payload)):
+    return await dispatch(payload)
+
+
+@handler(Type.SHORTCUT, 'edit_emoji_set', Payload)
+async def edit_emoji_set(payload: Payload, team_conf: TeamConf):
+    # ショートカット（「emojiを追加」「emojiを編集」）を選択したイベント
+    from slack_sdk.models.blocks import InputBlock, Option, PlainTextInputElement, RadioButtonsElement
+    from slack_sdk.models.views import View
+
+    from app.slack import get_client
+    client = get_client(team_conf.team_id, team_conf.access_token)
+    emoji_set = team_conf.emoji_set
+    # 登録できるemojiは3つまで
+    if emoji_set is None:
+        emoji_count = 0
+        external_input = 3
+        blocks = []
+    else:
+        emoji_count = len(emoji_set)
+        external_input = 3 - emoji_count
+        blocks = [
             InputBlock(
-                block_id=f'emoji_{emoji_count + i}',
-                label=f'追加するemoji（{emoji_count + i}つ目）',
-                element=PlainTextInputElement(action_id=f'emoji_{emoji_count + i}', placeholder=':atodeyomu:'),
+                block_id=f'emoji_{index}',
+                label=f':{item}:',
+                element=PlainTextInputElement(
+                    action_id=f'emoji_{index}',
+                    initial_value=item,
+                    placeholder=':atodeyomu:',
+                ),
                 optional=True,
-            ) for i in range(external_input)
+            ) for index, item in enumerate(emoji_set)
         ]
-        view = View(title='emojiを追加する', type='modal', callback_id='edit_emoji_set', blocks=blocks, submit='送信')
-        if payload.trigger_id:
-            client.views_open(trigger_id=payload.trigger_id, view=view)
+    blocks += [
+        InputBlock(
+            block_id=f'emoji_{emoji_count + i}',
+            label=f'追加するemoji（{emoji_count + i}つ目）',
+            element=PlainTextInputElement(action_id=f'emoji_{emoji_count + i}', placeholder=':atodeyomu:'),
+            optional=True,
+        ) for i in range(external_input)
+    ]
+    delivery_mode_options = [
+        Option(value=DeliveryMode.IMMEDIATE, text='リアクションのたびにDMを送る'),
+        Option(value=DeliveryMode.DIGEST, text='定期的にまとめてDMを送る'),
+    ]
+    blocks.append(
+        InputBlock(
+            block_id='delivery_mode',
+            label='DMの送り方',
+            element=RadioButtonsElement(
+                action_id='delivery_mode',
+                options=delivery_mode_options,
+                initial_option=delivery_mode_options[1 if team_conf.is_digest else 0],
+            ),
+        ))
+    view = View(title='emojiを追加する', type='modal', callback_id='edit_emoji_set', blocks=blocks, submit='送信')
+    if payload.trigger_id:
+        await client.views_open(trigger_id=payload.trigger_id, view=view)
     return Response()
 
 
-@router.post('/message/', name='actions_message', status_code=HTTPStatus.OK, dependencies=[Depends(verify_signature)])
-async def message(request: Request):
-    form = await request.form()
-    payload = ButtonActionPayload.parse_raw(form['payload'])
-    try:
-        team_conf = TeamConf.get(payload.team.id)
-    except TeamConf.DoesNotExist:
-        return Response(status_code=HTTPStatus.BAD_REQUEST)
-    if payload.actions[0].action_id == 'mark_as_read':
-        client = WebClient(team_conf.access_token)
-        if payload.container:
-            channel = payload.container.channel_id
-            ts = payload.container.message_ts
-            if channel and ts:
-                client.chat_delete(channel=channel, ts=ts)
+@handler(Type.BLOCK_ACTIONS, 'mark_as_read', ButtonActionPayload)
+async def mark_as_read(payload: ButtonActionPayload, team_conf: TeamConf):
+    # 「読んだ」ボタンを押したイベント
+    from app.slack import get_client
+    client = get_client(team_conf.team_id, team_conf.access_token)
+    item_key = payload.actions[0].value
+    if ':' in item_key:
+        # 以前に送ったDMのボタンにはitem_keyが入っていない
+        SavedItem.mark_as_read(team_conf.team_id, payload.user.id, item_key)
+    if payload.container and payload.container.is_message:
+        channel = payload.container.channel_id
+        ts = payload.container.message_ts
+        if channel and ts:
+            blocks = payload.message.blocks if payload.message else []
+            remaining_blocks = remove_item_blocks(blocks, item_key)
+            if has_item_blocks(remaining_blocks):
+                # まとめて送ったDMは押されたメッセージだけを取り除く
+                await client.chat_update(channel=channel, ts=ts, blocks=remaining_blocks)
+            else:
+                await client.chat_delete(channel=channel, ts=ts)
+    if payload.container and payload.container.is_view:
+        # App Homeで押された場合は表示している一覧を描画し直す
+        await home.refresh(team_conf, payload.user.id, publish_view=True)
+    else:
+        await home.refresh(team_conf, payload.user.id)
     return Response()
 
 
-@serverless_function
-@router.post(
-    '/view_submission/',
-    name='actions_views_submission',
-    status_code=HTTPStatus.OK,
-    dependencies=[Depends(verify_signature)],
-)
-async def view_submission(request: Request):
-    form = await request.form()
-    payload = ViewSubmissionPayload.parse_raw(form['payload'])
-    try:
-        team_conf = TeamConf.get(payload.team.id)
-    except TeamConf.DoesNotExist:
-        return Response(status_code=HTTPStatus.BAD_REQUEST)
-    if payload.view.callback_id == 'edit_emoji_set':
-        emojis: Dict[str, str] = {block_id: v[block_id]['value'] for block_id, v in payload.view.state.values.items()}
-        client = WebClient(team_conf.access_token)
-        slack_registered_emoji_list = list(client.emoji_list().get('emoji').keys())
-        unicode_emoji_list = list(map(lambda x: x.strip(':'), emoji.unicode_codes.EMOJI_UNICODE_ENGLISH.keys()))
-        available_emoji_list = slack_registered_emoji_list + unicode_emoji_list
-        errors = {}
-        for key, value in emojis.items():
-            if value is None:
-                continue
-            if value.strip(':') not in available_emoji_list:
-                errors[key] = '登録されていないemojiです'
-        if len(errors):
-            return {'response_action': 'errors', "errors": errors}
-        team_conf.emoji_set = set(map(lambda x: x.strip(':'), filter(lambda x: x, list(emojis.values()))))
-        team_conf.save()
+@handler(Type.BLOCK_ACTIONS, 'home_page', ButtonActionPayload)
+async def home_page(payload: ButtonActionPayload, team_conf: TeamConf):
+    # App Homeの一覧で「次へ」「最初に戻る」を押したイベント
+    await home.show_page(team_conf, payload.user.id, payload.actions[0].value)
+    return Response()
+
+
+@handler(Type.SHORTCUT, 'mark_all_as_read', Payload)
+@handler(Type.BLOCK_ACTIONS, 'mark_all_as_read', ButtonActionPayload)
+async def mark_all_as_read(payload: Payload, team_conf: TeamConf):
+    # ショートカットかApp Homeの「すべて既読にする」ボタンから、保存したメッセージをまとめて既読にする
+    await bulk.start(team_conf.team_id, payload.user.id)
+    return Response()
+
+
+@handler(Type.VIEW_SUBMISSION, 'edit_emoji_set', ViewSubmissionPayload)
+async def submit_emoji_set(payload: ViewSubmissionPayload, team_conf: TeamConf):
+    # モーダルに入力した内容を送信するイベント
+    from app.slack import get_client
+    values = payload.view.state.values
+    emojis: Dict[str, str] = {
+        block_id: v[block_id]['value']
+        for block_id, v in values.items() if block_id.startswith('emoji_')
+    }
+    client = get_client(team_conf.team_id, team_conf.access_token)
+    # 別のコンテナにemoji_changedイベントが届いて、追加したばかりのemojiがキャッシュにない場合は取り直す
+    names = [normalize(value) for value in emojis.values() if value is not None and not is_unicode_emoji(value)]
+    custom_emoji = await get_custom_emoji(team_conf.team_id, client, names)
+    errors = {}
+    for key, value in emojis.items():
+        if value is None:
+            continue
+        if not is_unicode_emoji(value) and normalize(value) not in custom_emoji:
+            errors[key] = '登録されていないemojiです'
+    if len(errors):
+        return {'response_action': 'errors', "errors": errors}
+    emoji_set = set(map(normalize, filter(lambda x: x, list(emojis.values()))))
+    selected_delivery_mode = values.get('delivery_mode', {}).get('delivery_mode', {}).get('selected_option')
+    delivery_mode = DeliveryMode(selected_delivery_mode['value']) if selected_delivery_mode else None
+    # 項目全体を保存するとアクセストークンも暗号化し直すため、変わった属性だけを更新する
+    team_conf.update_settings(emoji_set, delivery_mode)
     return Response()
@@ -1,14 +1,13 @@
 """OAuth"""
 import logging
 from http import HTTPStatus
+from typing import Optional
 from fastapi.param_functions import Query
 
 from pydantic import BaseModel, parse_obj_as
 from fastapi import APIRouter
 from fastapi.responses import HTMLResponse
-from sentry_sdk.integrations.serverless import serverless_function
-from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
+from app.datetime import now
 from app.models import TeamConf
 from app.settings import settings
 
@@ -28,12 +27,27 @@ class SlackResponse(BaseModel):
     team: Team
 
 
-@serverless_function
+async def get_workspace_url(team_id: str, access_token: str) -> Optional[str]:
+    """パーマリンクを組み立てるためにワークスペースのURLを取得する"""
+    from slack_sdk.errors import SlackApiError
+
+    from app.slack import get_client
+    try:
+        response = await get_client(team_id, access_token).auth_test()
+    except SlackApiError as e:
+        logger.error(e, exc_info=True)
+        return None
+    return response.get('url')
+
+
 @router.get('/', response_class=HTMLResponse)
 async def authorize(code: str):
-    client = WebClient()
+    from slack_sdk.errors import SlackApiError
+
+    from app.slack import get_client
+    client = get_client()
     try:
-        response = client.oauth_v2_access(
+        response = await client.oauth_v2_access(
             code=code,
             client_id=settings.SLACK_CLIENT_ID,
             client_secret=settings.SLACK_CLIENT_SECRET,
@@ -43,10 +57,13 @@ async def authorize(code: str):
         logger.error(e, exc_info=True)
         return HTMLResponse('インストールに失敗しました', status_code=HTTPStatus.BAD_REQUEST)
     slack_response = parse_obj_as(SlackResponse, response.data)
-    try:
-        team_conf = TeamConf.get(slack_response.team.id)
-        team_conf.access_token = slack_response.access_token
-        team_conf.save()
-    except TeamConf.DoesNotExist:
-        TeamConf(slack_response.team.id, access_token=slack_response.access_token).save()
+    url = await get_workspace_url(slack_response.team.id, slack_response.access_token)
+    # 読み込んでから保存すると同時のインストールで競合するため、1回のUpdateItemで作成または更新する
+    actions = [
+        TeamConf.access_token.set(slack_response.access_token),
+        TeamConf.created_at.set(TeamConf.created_at | now()),
+    ]
+    if url is not None:
+        actions.append(TeamConf.url.set(url))
+    TeamConf.upsert(slack_response.team.id, actions)
     return HTMLResponse('登録が完了しました')
@@ -1,18 +1,18 @@
 """SlackのEventSubscriptionを処理する"""
+import asyncio
 from http import HTTPStatus
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
-from fastapi import APIRouter, Response, Depends
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from sentry_sdk.integrations.serverless import serverless_function
-from slack_sdk import WebClient
-from slack_sdk.models.blocks import MarkdownTextObject
-from slack_sdk.models.blocks.block_elements import ButtonElement
-from slack_sdk.models.blocks.blocks import ActionsBlock, SectionBlock
+from fastapi import APIRouter, Depends, Header, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ValidationError
 
-from app.dependencies import verify_signature
-from app.models import TeamConf
+from app import home, metrics, timing, worker
+from app.dependencies import slack_payload, verify_signature
+from app.emojis import apply_emoji_changed, normalize
+from app.models import DigestItem, ProcessedEvent, SavedItem, TeamConf, get_emoji_index, get_team_conf
+from app.settings import settings
 
 router = APIRouter(prefix='/events')
 
@@ -23,47 +23,181 @@ class ReactionAddedEventItem(BaseModel):
     ts: str
 
 
+class HomeView(BaseModel):
+    private_metadata: Optional[str] = None
+
+
 class Event(BaseModel):
     type: str
-    user: str
+    user: Optional[str] = None
     item: Optional[ReactionAddedEventItem] = None
-    reaction: str
+    reaction: Optional[str] = None
     event_ts: str
+    # emoji_changed
+    subtype: Optional[str] = None
+    name: Optional[str] = None
+    names: Optional[List[str]] = None
+    old_name: Optional[str] = None
+    new_name: Optional[str] = None
+    # app_home_opened
+    tab: Optional[str] = None
+    view: Optional[HomeView] = None
 
 
 class EventCallback(BaseModel):
     type: str
     token: str
+    event_id: Optional[str] = None
+    event_time: Optional[int] = None
     challenge: Optional[str] = None
     team_id: Optional[str] = None
     event: Optional[Event] = None
 
 
-@serverless_function
+async def event_callback(request: Request, payload: dict = Depends(slack_payload)) -> EventCallback:
+    """読み込み済みのpayloadをEventCallbackとして検証する"""
+    try:
+        event = EventCallback.parse_obj(payload)
+    except ValidationError as e:
+        raise RequestValidationError(e.raw_errors)
+    request.state.event = event
+    return event
+
+
+async def notify(team_conf: TeamConf, user: str, item: ReactionAddedEventItem):
+    """リアクションされた投稿のリンクをリアクションしたユーザーにDMで送る
+
+    まとめて送る設定のチームは送るまで保存しておく
+    """
+    # Slack APIのクライアントやBlock Kitのモデルは読み込みに時間がかかるため、DMを送るときに初めて読み込む
+    from slack_sdk.models.blocks import MarkdownTextObject
+    from slack_sdk.models.blocks.block_elements import ButtonElement
+    from slack_sdk.models.blocks.blocks import ActionsBlock, SectionBlock
+
+    from app.slack import get_client, get_permalink, workspace_url_from_permalink
+    timing.set_team(team_conf.team_id)
+    client = get_client(team_conf.team_id, team_conf.access_token)
+    url = await get_permalink(client, team_conf.team_id, team_conf.url, item.channel, item.ts)
+    if team_conf.url is None:
+        # URLを保存する前にインストールされたワークスペースは、取得したパーマリンクからURLを保存する
+        workspace_url = workspace_url_from_permalink(url)
+        if workspace_url:
+            team_conf = TeamConf.upsert(team_conf.team_id, [TeamConf.url.set(workspace_url)],
+                                        condition=TeamConf.team_id.exists())
+    saved = SavedItem.create(team_conf.team_id, user, item.channel, item.ts, url)
+    await home.refresh(team_conf, user)
+    if team_conf.is_digest:
+        DigestItem.create(team_conf.team_id, user, item.channel, item.ts, url)
+        return
+    blocks = [
+        SectionBlock(text=MarkdownTextObject(text=f'<{url}>')),
+        ActionsBlock(elements=[ButtonElement(text='読んだ', action_id='mark_as_read', value=saved.item_key)])
+    ]
+    await client.chat_postMessage(text=url, channel=user, unfurl_links=True, blocks=blocks)
+
+
+async def process(event: EventCallback, team_conf: Optional[TeamConf] = None):
+    """レスポンスを返した後にイベントを処理する"""
+    if not event.team_id or not event.event or not event.event.user:
+        return
+    if team_conf is None:
+        team_conf = await get_team_conf(event.team_id)
+    if event.event.type == 'reaction_added' and event.event.item:
+        await notify(team_conf, event.event.user, event.event.item)
+    elif event.event.type == 'app_home_opened':
+        await home.open_home(team_conf, event.event.user, event.event.view.private_metadata if event.event.view else None)
+
+
+async def dispatch(event: EventCallback, team_conf: TeamConf):
+    """Slackの再送を避けるため、Slack APIの呼び出しはレスポンスを返してから行う
+
+    Mangumはレスポンスを返す前にキューを処理し終えるため、LambdaではEVENT_FUNCTIONに任せてすぐにレスポンスを返す
+    """
+    if settings.EVENT_FUNCTION:
+        await asyncio.get_event_loop().run_in_executor(None, worker.invoke, settings.EVENT_FUNCTION,
+                                                       event.dict(exclude_none=True))
+        timing.set_outcome('handed_off')
+        return
+    await worker.queue.enqueue(process, event, team_conf)
+    timing.set_outcome('enqueued')
+
+
+def handler(event: Dict[str, Any], context: Any):
+    """EVENT_FUNCTIONとして非同期に呼び出されるLambdaのエントリーポイント"""
+    from sentry_sdk.integrations.serverless import serverless_function
+
+    def process_event():
+        with timing.measure('event'):
+            asyncio.get_event_loop().run_until_complete(process(EventCallback.parse_obj(event)))
+
+    serverless_function(process_event)()
+
+
 @router.post('/', status_code=HTTPStatus.OK, dependencies=[Depends(verify_signature)])
-async def events(event: EventCallback):
+async def events(event: EventCallback = Depends(event_callback), x_slack_retry_num: Optional[int] = Header(None)):
+    return await handle_event(event, x_slack_retry_num)
+
+
+async def handle_event(event: EventCallback, retry_num: Optional[int] = None) -> Response:
+    """イベントを処理する。HTTPとSocket Modeのどちらで受け取ったイベントもここで処理する"""
     if event.type == 'url_verification':
         # AppにRequest URLを登録した際に初回だけ送信されるURLの検証
         # ref: https://api.slack.com/events/url_verification
-        return JSONResponse({'challenge': event.challenge})
+        timing.set_outcome('url_verification')
+        return ORJSONResponse({'challenge': event.challenge})
+    if event.event and event.event.type == 'emoji_changed':
+        # ワークスペースのカスタムemojiが追加・削除・名前変更されたイベント
+        # ref: https://api.slack.com/events/emoji_changed
+        timing.set_team(event.team_id)
+        timing.set_outcome('emoji_changed')
+        if event.team_id:
+            apply_emoji_changed(
+                event.team_id,
+                event.event.subtype,
+                name=event.event.name,
+                names=event.event.names,
+                old_name=event.event.old_name,
+                new_name=event.event.new_name,
+            )
+        return Response()
+    timing.set_team(event.team_id)
+    if event.event and event.event.type == 'reaction_added' and event.team_id:
+        # ほとんどのリアクションは設定されていないemojiのため、TeamConfを読み込んでアクセストークンを復号する前に無視する
+        try:
+            emoji_set = await get_emoji_index(event.team_id)
+        except TeamConf.DoesNotExist:
+            return Response(status_code=HTTPStatus.BAD_REQUEST)
+        if not event.event.reaction or normalize(event.event.reaction) not in emoji_set:
+            metrics.incr('events.prefiltered')
+            timing.set_outcome('ignored')
+            return Response()
+    if event.team_id is None:
+        return Response(status_code=HTTPStatus.BAD_REQUEST)
     try:
-        team_conf = TeamConf.get(event.team_id)
+        team_conf = await get_team_conf(event.team_id)
     except TeamConf.DoesNotExist:
         return Response(status_code=HTTPStatus.BAD_REQUEST)
-    client = WebClient(team_conf.access_token)
     if event.event:
         if event.event.type == 'reaction_added':
             # 投稿にemojiでリアクションがあったイベントを処理する
             # ref: https://api.slack.com/events/reaction_added
-            if event.event.reaction in team_conf.emoji_set:
+            if event.event.reaction and normalize(event.event.reaction) in team_conf.emoji_set:
                 # リアクションのemojiが設定されている場合
-                if event.event.item:
-                    item = event.event.item
-                    url = client.chat_getPermalink(channel=item.channel, message_ts=item.ts).get('permalink')
-                    blocks = [
-                        SectionBlock(text=MarkdownTextObject(text=f'<{url}>')),
-                        ActionsBlock(
-                            elements=[ButtonElement(text='読んだ', action_id='mark_as_read', value='mark_as_read')])
-                    ]
-                    client.chat_postMessage(text=url, channel=event.event.user, unfurl_links=True, blocks=blocks)
+                if event.event.item and event.event.user:
+                    if retry_num is not None:
+                        metrics.incr('events.retries')
+                    if event.event_id and not ProcessedEvent.claim(event.event_id):
+                        # 処理済みのイベントが再送された場合
+                        metrics.incr('events.duplicates_suppressed')
+                        timing.set_outcome('duplicate')
+                        return Response()
+                    await dispatch(event, team_conf)
+                    return Response()
+        elif event.event.type == 'app_home_opened':
+            # App Homeのタブが開かれたイベント。表示されているビューが最新であれば何もしない
+            # ref: https://api.slack.com/events/app_home_opened
+            if event.event.tab == 'home' and event.event.user:
+                await dispatch(event, team_conf)
+                return Response()
+    timing.set_outcome('ignored')
     return Response()
@@ -0,0 +1,97 @@
+"""キャッシュと接続を事前に温める
+
+コンテナなどプロセスが常駐する場合は起動時に、Lambdaではスケジュール実行で呼び出し、
+最初のリクエストでDynamoDBの読み込みやFernetの復号、TLSの接続を待たないようにする。
+"""
+import asyncio
+import logging
+from typing import Any, Dict, List
+
+from app import metrics
+from app.emojis import get_custom_emoji, unicode_emoji
+from app.models import TeamConf
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+def load_team_confs(limit: int) -> List[TeamConf]:
+    """TeamConfをScanで読み込んでキャッシュする
+
+    読み込む際にアクセストークンを復号するため、復号した値もキャッシュされる。
+    次に温めるまで失効しないよう、WARM_UP_TTL秒キャッシュする。
+    Scanは読み込んだ項目の分だけ読み込みキャパシティを使うため、limitで件数を抑え、page_sizeを小さくして一度に使う量を抑える
+    """
+    team_confs = []
+    for team_conf in TeamConf.scan(limit=limit, page_size=min(limit, 25)):
+        team_conf.cache(settings.WARM_UP_TTL)
+        team_confs.append(team_conf)
+    metrics.incr('warmup.team_confs', len(team_confs))
+    return team_confs
+
+
+async def open_connections():
+    """Slack APIとDynamoDBへの接続を開いておく"""
+    from app.slack import get_session
+    try:
+        # api.testは認証が不要なため、接続を確立するためだけに呼び出す
+        async with get_session().get(f'{settings.SLACK_API_URL}api.test') as response:
+            await response.read()
+    except Exception as e:
+        logger.warning('failed to connect to Slack API: %s', e)
+    TeamConf.describe_table()
+
+
+async def load_custom_emoji(team_confs: List[TeamConf]):
+    from app.slack import get_client
+    semaphore = asyncio.Semaphore(settings.WORKER_CONCURRENCY)
+
+    async def load(team_conf: TeamConf):
+        async with semaphore:
+            try:
+                await get_custom_emoji(team_conf.team_id, get_client(team_conf.team_id, team_conf.access_token))
+            except Exception as e:
+                logger.warning('failed to load custom emoji of %s: %s', team_conf.team_id, e)
+
+    await asyncio.gather(*(load(team_conf) for team_conf in team_confs))
+
+
+async def warm_up() -> int:
+    """温めたTeamConfの数を返す
+
+    失敗してもリクエストの処理はできるため、ログを残して続ける
+    """
+    try:
+        unicode_emoji()
+        await open_connections()
+        team_confs = load_team_confs(settings.WARM_UP_LIMIT)
+        if settings.WARM_UP_CUSTOM_EMOJI:
+            # emoji.listはレート制限が厳しいため、設定した場合だけ読み込む
+            await load_custom_emoji(team_confs)
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        return 0
+    logger.info('warmed up %d team_confs', len(team_confs))
+    return len(team_confs)
+
+
+def is_warm_up_event(event: Any) -> bool:
+    """スケジュール実行で温めるために送られたイベントか
+
+    serverless.ymlのscheduleでinputに{"warmup": true}を指定して送る
+    """
+    return isinstance(event, dict) and event.get('warmup') is True
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """Lambdaのコンテナでキャッシュと接続を温める
+
+    Mangumと同じイベントループで実行し、開いた接続を後のリクエストで使い回す
+    """
+    team_confs = asyncio.get_event_loop().run_until_complete(warm_up())
+    return {'warmed_up': team_confs}
+
+
+async def close_connections():
+    from app.slack import close_session
+    await close_session()
@@ -0,0 +1,111 @@
+"""レスポンスを返した後に処理するジョブのキュー
+
+Slackは3秒以内にレスポンスがないとイベントを再送するため、
+Slack APIの呼び出しなど時間のかかる処理はキューに積んでワーカーで処理する。
+Mangumではレスポンスを返す前にshutdownでキューを処理し終えるため、レスポンスを先に返せるのは常駐する場合だけになる。
+Lambdaではinvokeで別のLambdaを非同期に呼び出して処理を任せる。
+"""
+import asyncio
+import json
+import logging
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from app import metrics, timing
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+Job = Callable[..., Awaitable[Any]]
+
+
+class WorkQueue:
+    """asyncioのタスクで並行数を制限してジョブを処理するキュー"""
+    def __init__(self, name: str, concurrency: int, maxsize: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._workers: List[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def _ensure_workers(self) -> asyncio.Queue:
+        loop = asyncio.get_event_loop()
+        if self._queue is None or self._loop is not loop:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+            self._loop = loop
+            self._workers = []
+        if not self._workers:
+            self._workers = [loop.create_task(self._work()) for _ in range(self.concurrency)]
+        return self._queue
+
+    async def _work(self):
+        assert self._queue is not None
+        queue = self._queue
+        while True:
+            job, args, kwargs = await queue.get()
+            try:
+                with timing.measure(f"{self.name}.{getattr(job, '__name__', 'job')}"):
+                    metrics.gauge(f'{self.name}.queue_depth', queue.qsize())
+                    await job(*args, **kwargs)
+                    metrics.incr(f'{self.name}.processed')
+            except Exception as e:
+                metrics.incr(f'{self.name}.failed')
+                logger.error(e, exc_info=True)
+            finally:
+                queue.task_done()
+
+    async def enqueue(self, job: Job, *args, **kwargs):
+        """ジョブをキューに積む
+
+        キューが溢れている場合はその場で処理する
+        """
+        queue = self._ensure_workers()
+        try:
+            queue.put_nowait((job, args, kwargs))
+        except asyncio.QueueFull:
+            metrics.incr(f'{self.name}.inline')
+            await job(*args, **kwargs)
+            return
+        metrics.incr(f'{self.name}.enqueued')
+        metrics.gauge(f'{self.name}.queue_depth', queue.qsize())
+
+    async def drain(self, timeout: Optional[float] = None):
+        """積まれているジョブを全て処理してワーカーを止める"""
+        if self._queue is None or self._loop is not asyncio.get_event_loop():
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error('%s: %d jobs were not processed before shutdown', self.name, self._queue.qsize())
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+queue = WorkQueue('worker', concurrency=settings.WORKER_CONCURRENCY, maxsize=settings.WORKER_QUEUE_SIZE)
+
+
+async def drain():
+    await queue.drain(settings.WORKER_DRAIN_TIMEOUT)
+
+
+@lru_cache()
+def get_lambda_client():
+    import boto3
+    return boto3.client('lambda', region_name='ap-northeast-1')
+
+
+def invoke(function_name: str, payload: Dict[str, Any]):
+    """Lambdaを非同期に呼び出す"""
+    get_lambda_client().invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps(payload).encode(),
+    )
+    metrics.incr('worker.handed_off')
@@ -0,0 +1,88 @@
+"""ベンチマーク用のSlack Web APIの代わりになるサーバー
+
+応答までの遅延とHTTP 429の割合を指定でき、メソッドごとの呼び出し回数を数える。
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from aiohttp import web
+
+
+class FakeSlack:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit_ratio: float = 0.0,
+                 retry_after: int = 1, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.rate_limited: Counter = Counter()
+        self.url: Optional[str] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._started = threading.Event()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/api/{method}', self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.random.random() < self.rate_limit_ratio:
+            self.rate_limited[method] += 1
+            body = {'ok': False, 'error': 'ratelimited'}
+            return web.json_response(body, status=429, headers={'Retry-After': str(self.retry_after)})
+        params: Dict[str, Any] = dict(request.query)
+        if request.content_type == 'application/json':
+            params.update(await request.json())
+        else:
+            params.update(await request.post())
+        return web.json_response({'ok': True, **self.respond(method, params)})
+
+    def respond(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """メソッドごとにアプリが参照する項目だけを返す"""
+        channel = params.get('channel', 'D0000000000')
+        if method == 'auth.test':
+            return {'url': 'https://example.slack.com/', 'team_id': 'T0000000000'}
+        if method == 'chat.getPermalink':
+            ts = params.get('message_ts', '0.0').replace('.', '')
+            return {'channel': channel, 'permalink': f'https://example.slack.com/archives/{channel}/p{ts}'}
+        if method in ('chat.postMessage', 'chat.update', 'chat.delete'):
+            return {'channel': channel, 'ts': params.get('ts') or f'{time.time():.6f}'}
+        if method == 'emoji.list':
+            return {'emoji': {'atodeyomu': 'https://emoji.example.com/atodeyomu.png'}}
+        return {}
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """別スレッドでサーバーを起動し、Web APIのベースURLを返す"""
+        threading.Thread(target=self._serve, args=(host, port), name='fake_slack', daemon=True).start()
+        self._started.wait()
+        return self.url  # type: ignore[return-value]
+
+    def _serve(self, host: str, port: int):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._runner = web.AppRunner(self.app())
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, host, port)
+        self._loop.run_until_complete(site.start())
+        port = site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+        self.url = f'http://{host}:{port}/api/'
+        self._started.set()
+        self._loop.run_forever()
+
+    def stop(self):
+        if self._loop is None or self._runner is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
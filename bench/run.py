@@ -0,0 +1,408 @@
+"""/v1/events と /v1/actions/ の負荷試験
+
+uvicornで起動したアプリに署名したリクエストを指定したRPSで送り、レイテンシとスループット、
+イベントあたりのSlack APIの呼び出し回数を出力する。
+Slack Web APIは bench.fake_slack で、DynamoDBはmotoで置き換える（--dynamodb-hostでDynamoDB Localなども使える）。
+
+    $ pipenv run bench --rps 100 --duration 30 --slack-latency 0.1 --slack-rate-limit 0.01
+
+--mode mangumでは、Lambdaと同じように1つずつapp_handlerを呼び出す。
+Lambdaのコールドスタートや課金の単位は再現しないため、CPU時間あたりの処理数の比較にだけ使う。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import aiohttp
+
+from bench.fake_slack import FakeSlack
+
+KINDS = ('reaction_added', 'block_actions', 'view_submission')
+EMOJI = 'atodeyomu'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('uvicorn', 'mangum'), default='uvicorn', help='アプリの起動方法')
+    parser.add_argument('--rps', type=float, default=50, help='1秒あたりに送るリクエストの数')
+    parser.add_argument('--duration', type=float, default=10, help='リクエストを送る秒数')
+    parser.add_argument('--teams', type=int, default=10, help='インストールされているワークスペースの数')
+    parser.add_argument('--mix', default='reaction_added=8,block_actions=1,view_submission=1', help='リクエストの種類ごとの比率')
+    parser.add_argument('--slack-latency', type=float, default=0.05, help='Slack APIの応答までの秒数')
+    parser.add_argument('--slack-jitter', type=float, default=0.0, help='Slack APIの応答に加えるランダムな遅延の最大秒数')
+    parser.add_argument('--slack-rate-limit', type=float, default=0.0, help='Slack APIがHTTP 429を返す割合')
+    parser.add_argument('--retry-after', type=int, default=1, help='HTTP 429のRetry-Afterの秒数')
+    parser.add_argument('--no-workspace-url', action='store_true', help='ワークスペースのURLを保存していない状態で試す')
+    parser.add_argument('--dynamodb-host', help='motoの代わりに使うDynamoDBのURL（例: http://localhost:8000）')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+    parser.add_argument('--timing-log', action='store_true', help='アプリが出力するEMFのログを表示する')
+    return parser.parse_args()
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in KINDS:
+            raise SystemExit(f'unknown request kind: {kind}')
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def configure(args, slack_url: str):
+    """アプリを読み込む前に環境変数で設定する"""
+    os.environ.update({
+        'ENVIRONMENT_NAME': 'bench',
+        'SLACK_API_URL': slack_url,
+        'SENTRY_DNS': '',
+        'TIMING_LOG': str(args.timing_log),
+        # uvicornではコンテナと同じように起動時に温め、終了時に接続を閉じる
+        'LONG_RUNNING': str(args.mode == 'uvicorn'),
+    })
+    for key, value in {
+            'DYNAMODB_TABLE': 'atodeyomu-bench',
+            'SLACK_SIGNING_SECRET': 'bench-signing-secret',
+            'SLACK_CLIENT_ID': 'bench',
+            'SLACK_CLIENT_SECRET': 'bench',
+            'ENCRYPTION_KEY': 'MDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDA=',
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing',
+            'AWS_DEFAULT_REGION': 'ap-northeast-1',
+    }.items():
+        os.environ.setdefault(key, value)
+    if args.dynamodb_host:
+        os.environ['DYNAMODB_HOST'] = args.dynamodb_host
+
+
+def setup_tables(teams: List[str], workspace_url: Optional[str]):
+    from app.models import DigestItem, ProcessedEvent, SavedItem, TeamConf
+    for model in (TeamConf, ProcessedEvent, DigestItem, SavedItem):
+        if not model.exists():
+            model.create_table(read_capacity_units=1, write_capacity_units=1, wait=True)
+    for team_id in teams:
+        TeamConf(team_id, access_token=f'xoxb-{team_id}', emoji_set={EMOJI}, url=workspace_url).save()
+
+
+class Traffic:
+    """署名したリクエストを組み立てる"""
+    def __init__(self, teams: List[str], signing_secret: str, seed: int):
+        from slack_sdk.signature import SignatureVerifier
+
+        self.teams = teams
+        self.verifier = SignatureVerifier(signing_secret)
+        self.random = random.Random(seed)
+        self.count = 0
+
+    def build(self, kind: str) -> Tuple[str, bytes, Dict[str, str]]:
+        self.count += 1
+        team_id = self.random.choice(self.teams)
+        user = f'U{self.random.randrange(100):010d}'
+        ts = f'{time.time():.6f}'
+        if kind == 'reaction_added':
+            path = '/v1/events/'
+            body = json.dumps(self.reaction_added(team_id, user, ts)).encode()
+            content_type = 'application/json'
+        else:
+            path = '/v1/actions/'
+            payload = self.block_actions(team_id, user, ts) if kind == 'block_actions' else self.view_submission(
+                team_id, user)
+            body = urlencode({'payload': json.dumps(payload)}).encode()
+            content_type = 'application/x-www-form-urlencoded'
+        timestamp = str(int(time.time()))
+        headers = {
+            'Content-Type': content_type,
+            'X-Slack-Request-Timestamp': timestamp,
+            'X-Slack-Signature': self.verifier.generate_signature(timestamp=timestamp, body=body),
+        }
+        return path, body, headers
+
+    def reaction_added(self, team_id: str, user: str, ts: str) -> dict:
+        channel = f'C{self.random.randrange(100):010d}'
+        return {
+            'token': 'token',
+            'team_id': team_id,
+            'type': 'event_callback',
+            'event_id': f'Ev{self.count:010d}',
+            'event_time': int(time.time()),
+            'event': {
+                'type': 'reaction_added',
+                'user': user,
+                'reaction': EMOJI,
+                'item': {
+                    'type': 'message',
+                    'channel': channel,
+                    'ts': ts
+                },
+                'event_ts': ts,
+            },
+        }
+
+    def block_actions(self, team_id: str, user: str, ts: str) -> dict:
+        return {
+            'type': 'block_actions',
+            'team': {
+                'id': team_id,
+                'domain': 'example'
+            },
+            'user': {
+                'id': user,
+                'team_id': team_id
+            },
+            'container': {
+                'type': 'message',
+                'message_ts': ts,
+                'channel_id': f'D{user[1:]}'
+            },
+            'trigger_id': 'trigger_id',
+            'message': {
+                'ts': ts,
+                'blocks': []
+            },
+            'actions': [{
+                'action_id': 'mark_as_read',
+                'value': 'mark_as_read',
+                'type': 'button',
+                'action_ts': ts
+            }],
+        }
+
+    def view_submission(self, team_id: str, user: str) -> dict:
+        values = {'emoji_0': {'emoji_0': {'type': 'plain_text_input', 'value': f':{EMOJI}:'}}}
+        for i in (1, 2):
+            values[f'emoji_{i}'] = {f'emoji_{i}': {'type': 'plain_text_input', 'value': None}}
+        values['delivery_mode'] = {'delivery_mode': {'type': 'radio_buttons', 'selected_option': {'value': 'immediate'}}}
+        return {
+            'type': 'view_submission',
+            'team': {
+                'id': team_id,
+                'domain': 'example'
+            },
+            'user': {
+                'id': user,
+                'team_id': team_id
+            },
+            'view': {
+                'callback_id': 'edit_emoji_set',
+                'state': {
+                    'values': values
+                }
+            },
+        }
+
+
+def start_server(port: int):
+    """uvicornを別スレッドで起動する"""
+    import uvicorn
+
+    from app import app
+
+    # キューに残った処理を終えるまでのCPU時間を計測するため、最後のshutdownで記録する
+    cpu: Dict[str, float] = {}
+    app.add_event_handler('shutdown', lambda: cpu.setdefault('end', time.thread_time()))
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    # シグナルハンドラはメインスレッドでしか登録できない
+    server.install_signal_handlers = lambda: None  # type: ignore[assignment]
+    thread = threading.Thread(target=server.run, name='uvicorn', daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise SystemExit('failed to start uvicorn')
+        time.sleep(0.05)
+    cpu['start'] = time.clock_gettime(time.pthread_getcpuclockid(thread.ident))  # type: ignore[arg-type]
+    return server, thread, cpu
+
+
+async def send_requests(base_url: str, traffic: Traffic, weights: Dict[str, float], rps: float,
+                        duration: float) -> Tuple[Dict[str, List[float]], Dict[str, int], float]:
+    """到着間隔を固定したopen loopでリクエストを送る
+
+    応答を待たずに次のリクエストを送るため、アプリが遅くなった場合も送信の速度は変わらない
+    """
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(base_url, connector=connector) as session:
+
+        async def send(kind: str):
+            path, body, headers = traffic.build(kind)
+            started_at = time.perf_counter()
+            try:
+                async with session.post(path, data=body, headers=headers) as res:
+                    await res.read()
+                    if res.status != 200:
+                        errors[kind] += 1
+            except aiohttp.ClientError:
+                errors[kind] += 1
+            latencies[kind].append(time.perf_counter() - started_at)
+
+        tasks = []
+        started_at = time.perf_counter()
+        for i, kind in enumerate(choose_kinds(traffic, weights, int(rps * duration))):
+            delay = started_at + i / rps - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(send(kind)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started_at
+    return latencies, errors, elapsed
+
+
+def choose_kinds(traffic: Traffic, weights: Dict[str, float], count: int) -> List[str]:
+    kinds = list(weights)
+    return traffic.random.choices(kinds, [weights[kind] for kind in kinds], k=count)
+
+
+def invoke_mangum(traffic: Traffic, weights: Dict[str, float], count: int) -> Tuple[dict, dict, float, float]:
+    """API Gatewayのイベントを組み立てて、Lambdaと同じように1つずつapp_handlerを呼び出す"""
+    from app import app_handler
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    started_at = time.perf_counter()
+    cpu_started_at = time.thread_time()
+    for kind in choose_kinds(traffic, weights, count):
+        path, body, headers = traffic.build(kind)
+        event = {
+            'resource': path,
+            'path': path,
+            'httpMethod': 'POST',
+            'headers': headers,
+            'multiValueHeaders': {key: [value] for key, value in headers.items()},
+            'queryStringParameters': None,
+            'multiValueQueryStringParameters': None,
+            'requestContext': {
+                'resourcePath': path,
+                'httpMethod': 'POST',
+                'path': f'/dev{path}',
+                'stage': 'dev',
+                'identity': {
+                    'sourceIp': '127.0.0.1'
+                },
+            },
+            'body': body.decode('utf-8'),
+            'isBase64Encoded': False,
+        }
+        invoked_at = time.perf_counter()
+        response = app_handler(event, None)
+        latencies[kind].append(time.perf_counter() - invoked_at)
+        if response['statusCode'] != 200:
+            errors[kind] += 1
+    result = latencies, errors, time.perf_counter() - started_at, time.thread_time() - cpu_started_at
+    # Lambdaではコンテナが再利用される間セッションを使い回すため、最後に閉じる
+    from app.slack import close_session
+    asyncio.get_event_loop().run_until_complete(close_session())
+    return result
+
+
+def percentile(values: List[float], p: float) -> float:
+    """nearest-rank法のパーセンタイル
+
+    >>> percentile([1.0, 2.0, 3.0, 4.0], 50)
+    2.0
+    >>> percentile([1.0, 2.0, 3.0, 4.0], 99)
+    4.0
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+def summarize(values: List[float], errors: int) -> dict:
+    return {
+        'count': len(values),
+        'errors': errors,
+        'p50_ms': round(percentile(values, 50) * 1000, 2),
+        'p95_ms': round(percentile(values, 95) * 1000, 2),
+        'p99_ms': round(percentile(values, 99) * 1000, 2),
+    }
+
+
+def report(args, latencies: Dict[str, List[float]], errors: Dict[str, int], elapsed: float, drained: float,
+           cpu_seconds: float, slack: FakeSlack) -> dict:
+    from app import metrics
+    total = [value for values in latencies.values() for value in values]
+    events = len(total)
+    slack_calls = sum(slack.calls.values())
+    return {
+        'mode': args.mode,
+        'rps': args.rps,
+        'duration': args.duration,
+        'throughput_rps': round(events / elapsed, 2) if elapsed else 0.0,
+        'drain_seconds': round(drained, 2),
+        'cpu_seconds': round(cpu_seconds, 3),
+        # アプリの処理に使ったCPU時間1秒あたりのリクエスト数（1コアあたりのスループットの上限）
+        'requests_per_cpu_second': round(events / cpu_seconds, 1) if cpu_seconds else 0.0,
+        'all': summarize(total, sum(errors.values())),
+        'kinds': {kind: summarize(latencies[kind], errors[kind]) for kind in sorted(latencies)},
+        'slack_calls': dict(sorted(slack.calls.items())),
+        'slack_rate_limited': dict(sorted(slack.rate_limited.items())),
+        'slack_calls_per_event': round(slack_calls / events, 3) if events else 0.0,
+        'metrics': metrics.snapshot(),
+    }
+
+
+def print_report(result: dict):
+    print(f"mode: {result['mode']}")
+    print(f"throughput: {result['throughput_rps']} req/s (target {result['rps']} req/s, {result['duration']}s)")
+    print(f"worker drain: {result['drain_seconds']}s")
+    print(f"app cpu: {result['cpu_seconds']}s ({result['requests_per_cpu_second']} req per cpu second)")
+    print(f"{'kind':<16}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, summary in [*result['kinds'].items(), ('all', result['all'])]:
+        print(f"{kind:<16}{summary['count']:>8}{summary['errors']:>8}"
+              f"{summary['p50_ms']:>10}{summary['p95_ms']:>10}{summary['p99_ms']:>10}")
+    print(f"slack calls: {result['slack_calls']} (429: {result['slack_rate_limited']})")
+    print(f"slack calls per event: {result['slack_calls_per_event']}")
+
+
+def main():
+    args = parse_args()
+    weights = parse_mix(args.mix)
+    slack = FakeSlack(args.slack_latency, args.slack_jitter, args.slack_rate_limit, args.retry_after, args.seed)
+    configure(args, slack.start())
+    mock = None
+    if not args.dynamodb_host:
+        from moto import mock_dynamodb2
+        mock = mock_dynamodb2()
+        mock.start()
+    try:
+        from app.settings import settings
+        teams = [f'T{i:010d}' for i in range(args.teams)]
+        setup_tables(teams, None if args.no_workspace_url else 'https://example.slack.com/')
+        traffic = Traffic(teams, settings.SLACK_SIGNING_SECRET, args.seed)
+        if args.mode == 'mangum':
+            # キューに残った処理は呼び出しごとのshutdownで終えるため、app_handlerの時間に含まれる
+            latencies, errors, elapsed, cpu_seconds = invoke_mangum(traffic, weights, int(args.rps * args.duration))
+            drained = 0.0
+        else:
+            server, thread, cpu = start_server(args.port)
+            latencies, errors, elapsed = asyncio.run(
+                send_requests(f'http://127.0.0.1:{args.port}', traffic, weights, args.rps, args.duration))
+            # shutdownでキューに残ったSlack APIの呼び出しを終えるまで待つ
+            stopped_at = time.perf_counter()
+            server.should_exit = True
+            thread.join()
+            drained = time.perf_counter() - stopped_at
+            cpu_seconds = cpu['end'] - cpu['start']
+        result = report(args, latencies, errors, elapsed, drained, cpu_seconds, slack)
+    finally:
+        slack.stop()
+        if mock is not None:
+            mock.stop()
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == '__main__':
+    main()
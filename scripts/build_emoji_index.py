@@ -0,0 +1,27 @@
+"""Unicodeのemojiの名前の一覧を生成する
+
+emojiパッケージは辞書が大きくLambdaの起動が遅くなるため、実行時には読み込まずに
+このスクリプトで生成した app/unicode_emoji.txt を参照する。
+
+    $ pipenv run build-emoji-index
+"""
+from pathlib import Path
+
+import emoji
+
+OUTPUT = Path(__file__).resolve().parent.parent / 'app' / 'unicode_emoji.txt'
+
+# Slackで肌の色を指定する際に使われる名前
+SKIN_TONES = [f'skin-tone-{i}' for i in range(2, 7)]
+
+
+def main():
+    names = set(SKIN_TONES)
+    for codes in (emoji.unicode_codes.EMOJI_UNICODE_ENGLISH, emoji.unicode_codes.EMOJI_ALIAS_UNICODE_ENGLISH):
+        names.update(name.strip(':') for name in codes.keys())
+    OUTPUT.write_text('\n'.join(sorted(names)) + '\n', encoding='utf-8')
+    print(f'{len(names)} names -> {OUTPUT}')
+
+
+if __name__ == '__main__':
+    main()
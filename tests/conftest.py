@@ -0,0 +1,14 @@
+import pytest
+
+from app import metrics
+from app.cache import clear_caches
+
+
+@pytest.fixture(autouse=True)
+def clear_process_state():
+    # テスト間でプロセス内のキャッシュとメトリクスを共有しない
+    clear_caches()
+    metrics.reset()
+    yield
+    clear_caches()
+    metrics.reset()
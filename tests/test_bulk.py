@@ -0,0 +1,110 @@
+import asyncio
+import json
+from unittest import mock
+
+from moto import mock_dynamodb2
+
+from app import bulk
+from app.models import SavedItem
+from app.settings import settings
+from tests.factories import get_object
+
+
+def saved_message(ts: str) -> dict:
+    return {
+        'ts': ts,
+        'blocks': [{
+            'type': 'actions',
+            'elements': [{
+                'type': 'button',
+                'action_id': 'mark_as_read',
+                'value': f'C0000000000:{ts}'
+            }]
+        }],
+    }
+
+
+HISTORY = [
+    {
+        'messages': [saved_message('1629891004.000000'), {'ts': '1629891003.000000'}],
+        'has_more': True
+    },
+    {
+        'messages': [saved_message('1629891002.000000')],
+        'has_more': False
+    },
+]
+
+
+def mock_slack():
+    return mock.patch.multiple(
+        'slack_sdk.web.async_client.AsyncWebClient',
+        conversations_open=mock.AsyncMock(return_value={'channel': {
+            'id': 'D0000000000'
+        }}),
+        chat_postMessage=mock.AsyncMock(return_value={'ts': '1629891010.000000'}),
+        conversations_history=mock.AsyncMock(side_effect=HISTORY),
+        chat_delete=mock.AsyncMock(),
+        chat_update=mock.AsyncMock(),
+    )
+
+
+def test_is_saved_message():
+    assert bulk.is_saved_message(saved_message('1629891004.000000'))
+    assert not bulk.is_saved_message({'ts': '1629891004.000000', 'text': '保存したメッセージをまとめて既読にしています'})
+
+
+@mock_dynamodb2
+@mock.patch('app.models.TeamConf.get', get_object)
+def test_run():
+    SavedItem.create_table()
+    SavedItem.create('T0000000000', 'U00XXXXXXX', 'C0000000000', '1629891004.000000', 'https://example.com')
+    job = bulk.MarkAllJob(team_id='T0000000000', user='U00XXXXXXX')
+    with mock_slack():
+        from slack_sdk.web.async_client import AsyncWebClient
+        rest = asyncio.get_event_loop().run_until_complete(bulk.run(job, lambda: float('inf')))
+        assert rest is None
+        # 「読んだ」ボタンのあるメッセージだけを削除する
+        assert [call.kwargs['ts'] for call in AsyncWebClient.chat_delete.call_args_list
+                ] == ['1629891004.000000', '1629891002.000000']
+        # 進み具合を伝えるDMを更新する
+        assert AsyncWebClient.chat_update.call_args.kwargs == {
+            'channel': 'D0000000000',
+            'ts': '1629891010.000000',
+            'text': '2件のメッセージを既読にしました',
+        }
+    items, _ = SavedItem.page('T0000000000', 'U00XXXXXXX', unread=True)
+    assert items == []
+
+
+@mock_dynamodb2
+@mock.patch('app.models.TeamConf.get', get_object)
+def test_run_resume():
+    """残り時間が少なくなったら処理した位置を返し、続きから処理する"""
+    SavedItem.create_table()
+    remaining = iter([float('inf'), 0])
+    job = bulk.MarkAllJob(team_id='T0000000000', user='U00XXXXXXX')
+    with mock_slack():
+        from slack_sdk.web.async_client import AsyncWebClient
+        rest = asyncio.get_event_loop().run_until_complete(bulk.run(job, lambda: next(remaining)))
+        assert rest is not None
+        assert rest.latest == '1629891003.000000'
+        assert rest.deleted == 1
+        rest = bulk.MarkAllJob.parse_obj(json.loads(json.dumps(rest.dict())))
+        assert asyncio.get_event_loop().run_until_complete(bulk.run(rest, lambda: float('inf'))) is None
+        assert AsyncWebClient.conversations_history.call_args.kwargs['latest'] == '1629891003.000000'
+        # DMのチャンネルと進み具合を伝えるDMは引き継ぐ
+        AsyncWebClient.conversations_open.assert_awaited_once()
+        AsyncWebClient.chat_postMessage.assert_awaited_once()
+        assert AsyncWebClient.chat_update.call_args.kwargs['text'] == '2件のメッセージを既読にしました'
+
+
+def test_start_lambda():
+    """Lambdaでは別の関数を非同期に呼び出す"""
+    with mock.patch.object(settings, 'MARK_ALL_FUNCTION', 'atodeyomu-test-markAll'), \
+            mock.patch('app.worker.get_lambda_client') as get_lambda_client:
+        asyncio.get_event_loop().run_until_complete(bulk.start('T0000000000', 'U00XXXXXXX'))
+    kwargs = get_lambda_client.return_value.invoke.call_args.kwargs
+    assert kwargs['FunctionName'] == 'atodeyomu-test-markAll'
+    assert kwargs['InvocationType'] == 'Event'
+    assert json.loads(kwargs['Payload'])['user'] == 'U00XXXXXXX'
@@ -0,0 +1,41 @@
+from freezegun import freeze_time
+
+from app.cache import TTLCache
+
+
+def test_get_and_set():
+    cache = TTLCache('test', maxsize=2)
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_lru_eviction():
+    cache = TTLCache('test', maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')  # aを参照したためbが最も古くなる
+    cache.set('c', 3)
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.evictions == 1
+
+
+def test_ttl():
+    cache = TTLCache('test', maxsize=2, ttl=10)
+    with freeze_time('2021-01-01 00:00:00') as frozen:
+        cache.set('a', 1)
+        frozen.tick(9)
+        assert cache.get('a') == 1
+        frozen.tick(1)
+        assert cache.get('a') is None
+        assert len(cache) == 0
+
+
+def test_pop():
+    cache = TTLCache('test', maxsize=2)
+    cache.set('a', 1)
+    assert cache.pop('a') == 1
+    assert cache.pop('a') is None
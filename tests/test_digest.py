@@ -0,0 +1,50 @@
+import asyncio
+from unittest import mock
+
+from moto import mock_dynamodb2
+
+from app.digest import flush, has_item_blocks, item_blocks, remove_item_blocks
+from app.models import DeliveryMode, DigestItem, TeamConf
+
+
+@mock_dynamodb2
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_postMessage', new_callable=mock.AsyncMock)
+def test_flush(chat_post_message):
+    TeamConf.create_table()
+    DigestItem.create_table()
+    TeamConf('T0000000000', access_token='access_token', delivery_mode=DeliveryMode.DIGEST).save()
+    DigestItem.create('T0000000000', 'U00XXXXXXX', 'C0000000000', '1629891004.013500', 'https://example.com/1')
+    # 同じメッセージは1件にまとめる
+    DigestItem.create('T0000000000', 'U00XXXXXXX', 'C0000000000', '1629891004.013500', 'https://example.com/1')
+    DigestItem.create('T0000000000', 'U00XXXXXXX', 'C0000000000', '1629891005.013500', 'https://example.com/2')
+    DigestItem.create('T0000000000', 'U00YYYYYYY', 'C0000000000', '1629891004.013500', 'https://example.com/1')
+    asyncio.get_event_loop().run_until_complete(flush())
+    assert chat_post_message.await_count == 2
+    blocks = {call.kwargs['channel']: call.kwargs['blocks'] for call in chat_post_message.call_args_list}
+    assert len(blocks['U00XXXXXXX']) == 1 + 2 * 2
+    assert len(blocks['U00YYYYYYY']) == 1 + 2
+    assert DigestItem.count() == 0
+
+
+@mock_dynamodb2
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_postMessage', new_callable=mock.AsyncMock)
+def test_flush_max_items(chat_post_message):
+    TeamConf.create_table()
+    DigestItem.create_table()
+    TeamConf('T0000000000', access_token='access_token', delivery_mode=DeliveryMode.DIGEST).save()
+    for i in range(3):
+        DigestItem.create('T0000000000', 'U00XXXXXXX', 'C0000000000', f'162989100{i}.013500', 'https://example.com')
+    with mock.patch('app.settings.settings.DIGEST_MAX_ITEMS', 2):
+        asyncio.get_event_loop().run_until_complete(flush())
+    chat_post_message.assert_awaited_once()
+    # 送りきれなかったものは次回に送る
+    assert DigestItem.count() == 1
+
+
+def test_remove_item_blocks():
+    blocks = [block.to_dict() for block in item_blocks('C0000000000:1', 'https://example.com/1')]
+    blocks += [block.to_dict() for block in item_blocks('C0000000000:2', 'https://example.com/2')]
+    remaining = remove_item_blocks(blocks, 'C0000000000:1')
+    assert len(remaining) == 2
+    assert has_item_blocks(remaining)
+    assert not has_item_blocks(remove_item_blocks(remaining, 'C0000000000:2'))
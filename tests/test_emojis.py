@@ -0,0 +1,61 @@
+import asyncio
+from unittest import mock
+
+import emoji
+
+from app.emojis import (apply_emoji_changed, custom_emoji_cache, custom_emoji_loaded, get_custom_emoji, is_unicode_emoji,
+                        normalize, unicode_emoji)
+
+
+def test_get_custom_emoji():
+    client = mock.Mock(emoji_list=mock.AsyncMock(return_value={'emoji': {'example': 'https://emoji.com/example.png'}}))
+    loop = asyncio.get_event_loop()
+    assert loop.run_until_complete(get_custom_emoji('T0000000000', client)) == {'example'}
+    assert loop.run_until_complete(get_custom_emoji('T0000000000', client)) == {'example'}
+    client.emoji_list.assert_awaited_once()
+
+
+def test_get_custom_emoji_refetch():
+    """キャッシュにない名前があれば、間隔を空けて1回だけemoji.listを呼び出し直す"""
+    client = mock.Mock(emoji_list=mock.AsyncMock(return_value={'emoji': {'example': 'https://emoji.com/example.png'}}))
+    loop = asyncio.get_event_loop()
+    custom_emoji_cache.set('T0000000000', {'old'})
+    assert loop.run_until_complete(get_custom_emoji('T0000000000', client, ['example'])) == {'example'}
+    assert loop.run_until_complete(get_custom_emoji('T0000000000', client, ['unknown'])) == {'example'}
+    client.emoji_list.assert_awaited_once()
+    custom_emoji_loaded.clear()
+    loop.run_until_complete(get_custom_emoji('T0000000000', client, ['unknown']))
+    assert client.emoji_list.await_count == 2
+
+
+def test_apply_emoji_changed():
+    custom_emoji_cache.set('T0000000000', {'example', 'old'})
+    apply_emoji_changed('T0000000000', 'add', name='added')
+    apply_emoji_changed('T0000000000', 'remove', names=['example'])
+    apply_emoji_changed('T0000000000', 'rename', old_name='old', new_name='new')
+    assert custom_emoji_cache.get('T0000000000') == {'added', 'new'}
+
+
+def test_apply_emoji_changed_not_cached():
+    apply_emoji_changed('T0000000000', 'add', name='added')
+    assert custom_emoji_cache.get('T0000000000') is None
+
+
+def test_normalize():
+    assert normalize(':atodeyomu:') == 'atodeyomu'
+    assert normalize('+1::skin-tone-3') == '+1'
+    assert normalize(':+1::skin-tone-3:') == '+1'
+
+
+def test_is_unicode_emoji():
+    assert is_unicode_emoji(':thumbsup:')
+    assert is_unicode_emoji('+1::skin-tone-3')
+    assert is_unicode_emoji('skin-tone-2')
+    assert not is_unicode_emoji('atodeyomu')
+
+
+def test_unicode_emoji_index_up_to_date():
+    """app/unicode_emoji.txt がemojiパッケージから生成した内容と一致する"""
+    names = {name.strip(':') for name in emoji.unicode_codes.EMOJI_ALIAS_UNICODE_ENGLISH.keys()}
+    names.update(name.strip(':') for name in emoji.unicode_codes.EMOJI_UNICODE_ENGLISH.keys())
+    assert names <= unicode_emoji()
@@ -0,0 +1,135 @@
+import asyncio
+from unittest import mock
+
+from moto import mock_dynamodb2
+
+from app import home, metrics
+from app.models import SavedItem
+from app.settings import settings
+from tests.factories import TeamConfFactory
+
+
+def save_items(count: int):
+    SavedItem.create_table()
+    for i in range(count):
+        SavedItem.create('T0000000000', 'U00XXXXXXX', 'C0000000000', f'16298910{i:02d}.013500', 'https://example.com')
+
+
+@mock_dynamodb2
+def test_render_pages():
+    save_items(5)
+    SavedItem.mark_as_read('T0000000000', 'U00XXXXXXX', 'C0000000000:1629891004.013500')
+    with mock.patch.object(settings, 'HOME_PAGE_SIZE', 3):
+        view = home.render('T0000000000', 'U00XXXXXXX')
+        # 見出し + 「すべて既読にする」 + 未読の3件 + 「次へ」
+        assert len(view['blocks']) == 1 + 1 + 3 * 2 + 1
+        next_button = view['blocks'][-1]['elements'][-1]
+        assert next_button['action_id'] == 'home_page'
+        view = home.render('T0000000000', 'U00XXXXXXX', next_button['value'])
+    # 既読にしたものは表示しない
+    assert len(view['blocks']) == 1 + 1 * 2 + 1
+    assert view['blocks'][1]['block_id'] == 'item:C0000000000:1629891000.013500'
+    assert [element['value'] for element in view['blocks'][-1]['elements']] == [home.FIRST_PAGE]
+
+
+@mock_dynamodb2
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.views_publish', new_callable=mock.AsyncMock)
+def test_open_home(views_publish):
+    save_items(1)
+    team_conf = TeamConfFactory()
+    asyncio.get_event_loop().run_until_complete(home.open_home(team_conf, 'U00XXXXXXX'))
+    views_publish.assert_awaited_once()
+    published = views_publish.call_args.kwargs['view']['private_metadata']
+    # 表示されているビューが最新であれば公開しない
+    with mock.patch('app.models.SavedItem.query') as query:
+        asyncio.get_event_loop().run_until_complete(home.open_home(team_conf, 'U00XXXXXXX', published))
+        query.assert_not_called()
+    views_publish.assert_awaited_once()
+    assert metrics.counters['home.publish_skipped'] == 1
+
+
+@mock_dynamodb2
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.views_publish', new_callable=mock.AsyncMock)
+def test_refresh_coalesced(views_publish):
+    save_items(20)
+    team_conf = TeamConfFactory()
+    home.home_published_cache.set('T0000000000:U00XXXXXXX', 'published')
+
+    async def run():
+        for _ in range(20):
+            await home.refresh(team_conf, 'U00XXXXXXX')
+        await asyncio.sleep(0.2)
+
+    with mock.patch.multiple(settings, LONG_RUNNING=True, HOME_PUBLISH_DELAY=0.1):
+        asyncio.get_event_loop().run_until_complete(run())
+    # 待っている間の変更は1回の views.publish にまとめる
+    views_publish.assert_awaited_once()
+    assert metrics.counters['home.publish_coalesced'] == 19
+
+
+@mock_dynamodb2
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.views_publish', new_callable=mock.AsyncMock)
+def test_refresh_lambda(views_publish):
+    """Lambdaではキャッシュを捨てるだけで、次にApp Homeが開かれたときに描画し直す"""
+    save_items(1)
+    team_conf = TeamConfFactory()
+    home.get_view('T0000000000', 'U00XXXXXXX')
+
+    async def run():
+        await home.refresh(team_conf, 'U00XXXXXXX')
+        await home.drain()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    views_publish.assert_not_called()
+    assert 'T0000000000:U00XXXXXXX' not in home.home_view_cache
+
+
+@mock_dynamodb2
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.views_publish', new_callable=mock.AsyncMock)
+def test_drain(views_publish):
+    """終了する前に待っている描画をすぐに行う"""
+    save_items(1)
+    team_conf = TeamConfFactory()
+
+    async def run():
+        await home.refresh(team_conf, 'U00XXXXXXX', publish_view=True)
+        await home.drain()
+
+    with mock.patch.object(settings, 'HOME_PUBLISH_DELAY', 60):
+        asyncio.get_event_loop().run_until_complete(asyncio.wait_for(run(), 5))
+    views_publish.assert_awaited_once()
+
+
+@mock_dynamodb2
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.views_publish', new_callable=mock.AsyncMock)
+def test_refresh_not_opened(views_publish):
+    """App Homeを開いたことのないユーザーは一覧が変わっても描画しない"""
+    save_items(1)
+    team_conf = TeamConfFactory()
+
+    async def run():
+        await home.refresh(team_conf, 'U00XXXXXXX')
+        await home.drain()
+
+    with mock.patch.object(settings, 'LONG_RUNNING', True):
+        asyncio.get_event_loop().run_until_complete(run())
+    views_publish.assert_not_called()
+
+
+async def publish_forever(**kwargs):
+    await asyncio.sleep(60)
+
+
+@mock_dynamodb2
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.views_publish', mock.AsyncMock(side_effect=publish_forever))
+def test_drain_timeout():
+    """描画が終わらなくてもHOME_DRAIN_TIMEOUT秒で終了する"""
+    save_items(1)
+    team_conf = TeamConfFactory()
+
+    async def run():
+        await home.refresh(team_conf, 'U00XXXXXXX', publish_view=True)
+        await home.drain()
+
+    with mock.patch.object(settings, 'HOME_DRAIN_TIMEOUT', 0.1):
+        asyncio.get_event_loop().run_until_complete(asyncio.wait_for(run(), 5))
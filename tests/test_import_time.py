@@ -0,0 +1,32 @@
+"""コールドスタートを遅くしないよう、`import app` にかかる時間を検証する"""
+import os
+import re
+import subprocess
+import sys
+
+# `import app` にかかる時間の上限（マイクロ秒）。Sentryの初期化を含めて約400msのため、実行環境の揺らぎを見込んで3割の余裕を持たせる
+IMPORT_TIME_BUDGET_US = 520_000
+
+# 最初のリクエストで必要になるまで読み込まないモジュール
+# pynamodbはすべてのリクエストでTeamConfを読むため、起動時に読み込む。
+# pynamodbが使うbotocoreはmangumが読み込むため、pynamodb自体にかかる時間は15ms程度
+LAZY_MODULES = ['aiohttp', 'cryptography', 'emoji', 'slack_sdk.models', 'slack_sdk.web.async_client']
+
+
+def run_python(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args], capture_output=True, text=True, env=os.environ.copy(), check=True)
+
+
+def test_import_time():
+    # 実行環境の揺らぎを避けるため最も速かった結果で比較する
+    cumulative = []
+    for _ in range(3):
+        result = run_python('-X', 'importtime', '-c', 'import app')
+        times = [int(m.group(1)) for m in re.finditer(r'\|\s*(\d+) \|\s+app$', result.stderr, re.MULTILINE)]
+        cumulative.append(max(times))
+    assert min(cumulative) < IMPORT_TIME_BUDGET_US
+
+
+def test_lazy_modules():
+    code = f'import sys, app; print([m for m in {LAZY_MODULES!r} if m in sys.modules])'
+    assert run_python('-c', code).stdout.strip() == '[]'
@@ -1,9 +1,15 @@
+import asyncio
+import time
 from datetime import datetime, timedelta, timezone
+from unittest import mock
 
+from cryptography.fernet import Fernet
 from freezegun import freeze_time
 from moto import mock_dynamodb2
 
-from app.models import TeamConf
+from app.models import (DeliveryMode, EncryptedStringAttribute, ProcessedEvent, SavedItem, TeamConf, get_emoji_index,
+                        get_fernet, get_team_conf, plaintext_cache, processed_event_cache)
+from app.settings import settings
 
 
 @mock_dynamodb2
@@ -18,3 +24,136 @@ def test_create():
     utc = timezone(timedelta(0))
     assert obj.created_at == datetime(2020, 1, 1, tzinfo=utc)
     assert obj.access_token == access_token
+
+
+@mock_dynamodb2
+def test_get_cached():
+    TeamConf.create_table()
+    TeamConf('team_id', access_token='access_token').save()
+    with mock.patch('pynamodb.connection.table.TableConnection.get_item') as get_item:
+        assert TeamConf.get('team_id').access_token == 'access_token'
+        get_item.assert_not_called()
+
+
+@mock_dynamodb2
+def test_save_refreshes_cache():
+    TeamConf.create_table()
+    TeamConf('team_id', access_token='access_token').save()
+    team_conf = TeamConf.get('team_id', consistent_read=True)
+    team_conf.emoji_set = {'atodeyomu'}
+    team_conf.save()
+    assert TeamConf.get('team_id').emoji_set == {'atodeyomu'}
+
+
+def test_encrypted_string_attribute_rotation():
+    old_key = Fernet.generate_key()
+    new_key = Fernet.generate_key()
+    attribute = EncryptedStringAttribute()
+    with mock.patch.object(settings, 'ENCRYPTION_KEY', old_key.decode()):
+        get_fernet.cache_clear()
+        old_token = attribute.serialize('access_token')
+    with mock.patch.object(settings, 'ENCRYPTION_KEY', f'{new_key.decode()},{old_key.decode()}'):
+        get_fernet.cache_clear()
+        plaintext_cache.clear()
+        assert attribute.deserialize(old_token) == 'access_token'
+        # 保存時は新しい鍵で暗号化される
+        new_token = attribute.serialize('access_token')
+        assert Fernet(new_key).decrypt(new_token) == b'access_token'
+    get_fernet.cache_clear()
+
+
+def test_encrypted_string_attribute_plaintext_cache():
+    attribute = EncryptedStringAttribute()
+    token = attribute.serialize('access_token')
+    with mock.patch('cryptography.fernet.MultiFernet.decrypt') as decrypt:
+        assert attribute.deserialize(token) == 'access_token'
+        decrypt.assert_not_called()
+
+
+@mock_dynamodb2
+def test_processed_event_claim():
+    ProcessedEvent.create_table()
+    assert ProcessedEvent.claim('Ev0000000000')
+    assert not ProcessedEvent.claim('Ev0000000000')
+    # 別のプロセスで処理済みのケース
+    processed_event_cache.clear()
+    assert not ProcessedEvent.claim('Ev0000000000')
+    assert ProcessedEvent.claim('Ev0000000001')
+
+
+@mock_dynamodb2
+def test_saved_item_create():
+    SavedItem.create_table()
+    saved = SavedItem.create('T0000000000', 'U00XXXXXXX', 'C0000000000', '1629891004.013500', 'https://example.com')
+    assert saved.item_key == 'C0000000000:1629891004.013500'
+    # 未読のまま同じメッセージにリアクションした場合は保存し直さない
+    SavedItem.create('T0000000000', 'U00XXXXXXX', 'C0000000000', '1629891004.013500', 'https://example.com')
+    assert SavedItem.count('T0000000000:U00XXXXXXX') == 1
+    assert SavedItem.mark_as_read('T0000000000', 'U00XXXXXXX', 'C0000000000:1629891004.013500') == 1
+    assert SavedItem.mark_as_read('T0000000000', 'U00XXXXXXX', 'C0000000000:1629891004.013500') == 0
+    # 既読にした後は改めて保存する
+    SavedItem.create('T0000000000', 'U00XXXXXXX', 'C0000000000', '1629891004.013500', 'https://example.com')
+    assert SavedItem.count('T0000000000:U00XXXXXXX') == 2
+
+
+@mock_dynamodb2
+def test_saved_item_page():
+    SavedItem.create_table()
+    for i in range(5):
+        with freeze_time(datetime(2021, 8, 1, tzinfo=timezone.utc) + timedelta(minutes=i)):
+            SavedItem.create('T0000000000', 'U00XXXXXXX', 'C0000000000', f'162989100{i}.013500', 'https://example.com')
+    items, cursor = SavedItem.page('T0000000000', 'U00XXXXXXX', limit=3)
+    # 新しい順に返す
+    assert [item.ts for item in items] == ['1629891004.013500', '1629891003.013500', '1629891002.013500']
+    assert cursor is not None
+    items, cursor = SavedItem.page('T0000000000', 'U00XXXXXXX', limit=3, cursor=cursor)
+    assert [item.ts for item in items] == ['1629891001.013500', '1629891000.013500']
+    assert cursor is None
+    # 最後のページでは続きのcursorを返さない
+    items, cursor = SavedItem.page('T0000000000', 'U00XXXXXXX', limit=5)
+    assert len(items) == 5
+    assert cursor is None
+
+
+def test_get_team_conf_coalesced():
+    """キャッシュにないTeamConfを同時に読み込む場合はDynamoDBへの問い合わせを1回にまとめる"""
+    def get(team_id: str):
+        time.sleep(0.05)
+        return TeamConf(team_id, access_token='xoxb-0')
+
+    async def run():
+        return await asyncio.gather(*(get_team_conf('T0000000000') for _ in range(5)))
+
+    with mock.patch('app.models.TeamConf.get', side_effect=get) as get_object:
+        team_confs = asyncio.get_event_loop().run_until_complete(run())
+    get_object.assert_called_once_with('T0000000000')
+    assert len({id(team_conf) for team_conf in team_confs}) == 1
+
+
+@mock_dynamodb2
+def test_emoji_index_updated_on_save():
+    TeamConf.create_table()
+    team_conf = TeamConf('T0000000000', access_token='xoxb-0', emoji_set={'atodeyomu'})
+    team_conf.save()
+    assert asyncio.get_event_loop().run_until_complete(get_emoji_index('T0000000000')) == {'atodeyomu'}
+    team_conf.emoji_set = {'eyes'}
+    team_conf.save()
+    assert asyncio.get_event_loop().run_until_complete(get_emoji_index('T0000000000')) == {'eyes'}
+
+
+@mock_dynamodb2
+def test_update_settings():
+    TeamConf.create_table()
+    TeamConf('T0000000000', access_token='xoxb-0', emoji_set={'atodeyomu', 'eyes'}).save()
+    team_conf = TeamConf.get('T0000000000')
+    # 読み込んだ後に別のコンテナで更新された場合は、読み直してやり直す
+    other = TeamConf.get('T0000000000', consistent_read=True)
+    other.update(actions=[TeamConf.url.set('https://example.slack.com/')])
+    with mock.patch('app.models.TeamConf.save') as save:
+        team_conf.update_settings({'eyes', 'memo'}, DeliveryMode.DIGEST)
+        save.assert_not_called()
+    team_conf = TeamConf.get('T0000000000', consistent_read=True)
+    assert team_conf.emoji_set == {'eyes', 'memo'}
+    assert team_conf.is_digest
+    assert team_conf.url == 'https://example.slack.com/'
+    assert team_conf.version == 3
@@ -0,0 +1,46 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from app import metrics
+from app.singleflight import SingleFlight
+
+
+def test_do_coalesced():
+    flight: SingleFlight[str, str] = SingleFlight('test')
+    func = mock.AsyncMock()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        await func()
+        return 'value'
+
+    async def run():
+        return await asyncio.gather(*(flight.do('key', fetch) for _ in range(5)))
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == ['value'] * 5
+    func.assert_awaited_once()
+    assert len(flight) == 0
+    assert metrics.counters['singleflight.test.calls'] == 1
+    assert metrics.counters['singleflight.test.coalesced'] == 4
+    # 問い合わせが終わった後は結果を共有しない
+    asyncio.get_event_loop().run_until_complete(flight.do('key', fetch))
+    assert func.await_count == 2
+
+
+def test_do_exception():
+    """問い合わせが失敗した場合は待っている呼び出しにも同じ例外を返す"""
+    flight: SingleFlight[str, str] = SingleFlight('test')
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise KeyError('key')
+
+    async def run():
+        return await asyncio.gather(*(flight.do('key', fetch) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.get_event_loop().run_until_complete(run())
+    assert all(isinstance(result, KeyError) for result in results)
+    with pytest.raises(KeyError):
+        asyncio.get_event_loop().run_until_complete(flight.do('key', fetch))
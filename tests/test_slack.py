@@ -0,0 +1,121 @@
+import asyncio
+from unittest import mock
+
+import pytest
+from freezegun import freeze_time
+from slack_sdk.errors import SlackApiError
+
+from app import metrics, timing
+from app.slack import RateLimitExceeded, TokenBucket, close_session, get_client, get_permalink, workspace_url_from_permalink
+
+
+def test_get_client_pooled_by_team():
+    async def run():
+        client = get_client('T0000000000', 'xoxb-token')
+        assert get_client('T0000000000', 'xoxb-token') is client
+        assert get_client('T0000000001', 'xoxb-other') is not client
+        assert get_client('T0000000001', 'xoxb-other').session is client.session
+        # トークンが変わった場合は作り直す
+        assert get_client('T0000000000', 'xoxb-new').token == 'xoxb-new'
+        await close_session()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_get_permalink_cached():
+    client = mock.Mock(chat_getPermalink=mock.AsyncMock(
+        return_value={'permalink': 'https://example.slack.com/archives/C0000000000/p1629891004013500'}))
+    loop = asyncio.get_event_loop()
+    for _ in range(2):
+        permalink = loop.run_until_complete(get_permalink(client, 'T0000000000', None, 'C0000000000',
+                                                          '1629891004.013500'))
+        assert permalink == 'https://example.slack.com/archives/C0000000000/p1629891004013500'
+    client.chat_getPermalink.assert_awaited_once()
+
+
+def test_workspace_url_from_permalink():
+    permalink = 'https://example.slack.com/archives/C0000000000/p1629891004013500'
+    assert workspace_url_from_permalink(permalink) == 'https://example.slack.com/'
+    assert workspace_url_from_permalink('https://example.com') is None
+
+
+class MockResponse:
+    def __init__(self, status_code: int, headers: dict):
+        self.status_code = status_code
+        self.headers = headers
+
+
+def test_rate_limited_retry():
+    rate_limited = SlackApiError('ratelimited', MockResponse(429, {'Retry-After': '0'}))
+    api_call = mock.AsyncMock(side_effect=[rate_limited, {'ok': True}])
+
+    async def run():
+        client = get_client('T0000000000', 'xoxb-token')
+        with mock.patch('slack_sdk.web.async_base_client.AsyncBaseClient.api_call', api_call):
+            assert await client.chat_delete(channel='C0000000000', ts='1629891004.013500') == {'ok': True}
+        await close_session()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert api_call.await_count == 2
+    assert metrics.counters['slack.chat.delete.rate_limited'] == 1
+
+
+def test_rate_limited_give_up():
+    rate_limited = SlackApiError('ratelimited', MockResponse(429, {'Retry-After': '0'}))
+    api_call = mock.AsyncMock(side_effect=rate_limited)
+
+    async def run():
+        client = get_client('T0000000000', 'xoxb-token')
+        with mock.patch('slack_sdk.web.async_base_client.AsyncBaseClient.api_call', api_call):
+            with pytest.raises(SlackApiError):
+                await client.chat_delete(channel='C0000000000', ts='1629891004.013500')
+        await close_session()
+
+    with mock.patch('app.settings.settings.SLACK_MAX_RETRIES', 1):
+        asyncio.get_event_loop().run_until_complete(run())
+    assert api_call.await_count == 2
+
+
+def test_token_bucket():
+    async def run():
+        with freeze_time('2021-01-01 00:00:00') as frozen:
+            with mock.patch('asyncio.sleep', side_effect=lambda delay: frozen.tick(delay)):
+                bucket = TokenBucket(per_minute=60)
+                bucket.tokens = 1
+                assert await bucket.acquire() == 0
+                # トークンが補充されるまで待つ
+                assert await bucket.acquire() == 1
+                # Retry-Afterで指定された秒数だけ待つ
+                bucket.block(5)
+                assert await bucket.acquire() == 5
+                assert await bucket.acquire() == 1
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_rate_limited_fail_fast():
+    """Slackに応答を返す前の処理ではRetry-Afterを待たずに失敗させる"""
+    rate_limited = SlackApiError('ratelimited', MockResponse(429, {'Retry-After': '30'}))
+    api_call = mock.AsyncMock(side_effect=[rate_limited, {'ok': True}])
+
+    async def run():
+        client = get_client('T0000000000', 'xoxb-token')
+        with mock.patch('slack_sdk.web.async_base_client.AsyncBaseClient.api_call', api_call):
+            with timing.measure('/v1/actions/', deadline=2.5):
+                with pytest.raises(SlackApiError):
+                    await client.chat_delete(channel='C0000000000', ts='1629891004.013500')
+                # レート制限が解除されるまでの呼び出しもSlack APIを呼び出さずに失敗させる
+                with pytest.raises(RateLimitExceeded):
+                    await client.chat_delete(channel='C0000000000', ts='1629891005.013500')
+        await close_session()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert api_call.await_count == 1
+    assert metrics.counters['slack.chat.delete.rejected'] == 1
+
+
+def test_token_bucket_burst():
+    """しばらく呼び出しがなくても、続けて呼び出せるのは数秒分まで"""
+    assert TokenBucket(per_minute=60, capacity=1).capacity == 1
+    assert TokenBucket(per_minute=50).capacity == 2.5
+    assert TokenBucket(per_minute=20).capacity == 1
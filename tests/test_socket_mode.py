@@ -0,0 +1,148 @@
+import asyncio
+import json
+from unittest import mock
+
+from aiohttp import WSMsgType, web
+from moto import mock_dynamodb2
+
+from app import socket_mode
+from app.models import ProcessedEvent, SavedItem
+from app.settings import settings
+from tests.factories import get_object
+
+
+class FakeSocketModeServer:
+    """apps.connections.openで発行したURLでWebSocketを受け付け、envelopeを送って応答を集める"""
+    def __init__(self, envelopes):
+        self.envelopes = envelopes
+        self.acks = {}
+        self.calls = []
+        self.done = asyncio.Event()
+        self.url = ''
+
+    async def api(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls.append(method)
+        if method == 'apps.connections.open':
+            return web.json_response({'ok': True, 'url': f'{self.url}link'})
+        if method == 'emoji.list':
+            return web.json_response({'ok': True, 'emoji': {}})
+        return web.json_response({'ok': True, 'channel': 'D0000000000', 'ts': '1629891004.013500'})
+
+    async def link(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(json.dumps({'type': 'hello'}))
+        for envelope in self.envelopes:
+            await ws.send_str(json.dumps(envelope))
+        async for message in ws:
+            if message.type == WSMsgType.TEXT:
+                ack = json.loads(message.data)
+                self.acks[ack['envelope_id']] = ack.get('payload')
+                if len(self.acks) == len(self.envelopes):
+                    self.done.set()
+        return ws
+
+    async def start(self) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_route('*', '/api/{method}', self.api)
+        app.router.add_get('/link', self.link)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        server = site._server
+        assert isinstance(server, asyncio.Server) and server.sockets
+        self.url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/"
+        return runner
+
+
+def reaction_added(event_id: str) -> dict:
+    return {
+        'type': 'event_callback',
+        'token': 'token',
+        'team_id': 'T0000000000',
+        'event_id': event_id,
+        'event': {
+            'type': 'reaction_added',
+            'user': 'U00XXXXXXX',
+            'item': {
+                'type': 'message',
+                'channel': 'C0000000000',
+                'ts': '1629891004.013500'
+            },
+            'reaction': 'atodeyomu',
+            'event_ts': '1629935430.003400'
+        },
+    }
+
+
+@mock_dynamodb2
+@mock.patch('app.models.TeamConf.get', get_object)
+def test_socket_mode():
+    ProcessedEvent.create_table()
+    SavedItem.create_table()
+    submission = {
+        'type': 'view_submission',
+        'team': {
+            'id': 'T0000000000',
+            'domain': 'team_domain'
+        },
+        'user': {
+            'id': 'U00XXXXXXX',
+            'team_id': 'T0000000000'
+        },
+        'view': {
+            'callback_id': 'edit_emoji_set',
+            'state': {
+                'values': {
+                    'emoji_0': {
+                        'emoji_0': {
+                            'type': 'plain_text_input',
+                            'value': ':unknown_emoji:'
+                        }
+                    }
+                }
+            }
+        },
+    }
+    envelopes = [
+        {
+            'type': 'events_api',
+            'envelope_id': 'e1',
+            'payload': reaction_added('Ev01')
+        },
+        {
+            'type': 'events_api',
+            'envelope_id': 'e2',
+            'payload': reaction_added('Ev02')
+        },
+        # 再送されたイベントは応答だけ返してDMは送らない
+        {
+            'type': 'events_api',
+            'envelope_id': 'e3',
+            'payload': reaction_added('Ev01'),
+            'retry_attempt': 1
+        },
+        {
+            'type': 'interactive',
+            'envelope_id': 'e4',
+            'payload': submission
+        },
+    ]
+    server = FakeSocketModeServer(envelopes)
+
+    async def run():
+        runner = await server.start()
+        stop = asyncio.Event()
+        with mock.patch.multiple(settings, SLACK_API_URL=f'{server.url}api/', SLACK_APP_TOKEN='xapp-token'):
+            task = asyncio.ensure_future(socket_mode.run(stop))
+            await asyncio.wait_for(server.done.wait(), 5)
+            stop.set()
+            await task
+        await runner.cleanup()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert set(server.acks) == {'e1', 'e2', 'e3', 'e4'}
+    assert server.acks['e4'] == {'response_action': 'errors', 'errors': {'emoji_0': '登録されていないemojiです'}}
+    assert server.calls.count('chat.postMessage') == 2
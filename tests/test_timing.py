@@ -0,0 +1,80 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import app, metrics, timing
+
+
+def test_phase_without_timing():
+    """計測中でなければ何もしない"""
+    with timing.phase('noop'):
+        pass
+    assert timing.current() is None
+
+
+def test_measure(capsys):
+    with timing.measure('worker.notify') as t:
+        with timing.phase('decrypt'):
+            pass
+        with timing.phase('decrypt'):
+            pass
+        timing.set_team('T0000000000')
+    assert list(t.phases) == ['decrypt']
+    log = json.loads(capsys.readouterr().out)
+    assert log['operation'] == 'worker.notify'
+    assert log['team_id'] == 'T0000000000'
+    assert log['outcome'] == 'ok'
+    assert 'decrypt' in log and 'total' in log
+    metric = log['_aws']['CloudWatchMetrics'][0]
+    assert metric['Dimensions'] == [['operation']]
+    assert {m['Name'] for m in metric['Metrics']} == {'decrypt', 'total'}
+
+
+def test_measure_metrics(capsys):
+    """計測中に記録したカウンターとゲージもEMFで出力する"""
+    metrics.incr('events.duplicates_suppressed')
+    with timing.measure('worker.notify'):
+        metrics.incr('slack.chat.postMessage.wait_seconds', 0.5)
+        metrics.incr('slack.chat.postMessage.wait_seconds', 0.25)
+        metrics.gauge('worker.queue_depth', 3)
+        metrics.gauge('worker.queue_depth', 2)
+    log = json.loads(capsys.readouterr().out)
+    assert log['slack.chat.postMessage.wait_seconds'] == 0.75
+    assert log['worker.queue_depth'] == 2
+    assert 'events.duplicates_suppressed' not in log
+    units = {m['Name']: m['Unit'] for m in log['_aws']['CloudWatchMetrics'][0]['Metrics']}
+    assert units['slack.chat.postMessage.wait_seconds'] == 'Seconds'
+    assert units['worker.queue_depth'] == 'Count'
+
+
+def test_measure_error(capsys):
+    with pytest.raises(ValueError):
+        with timing.measure('worker.notify'):
+            raise ValueError
+    assert json.loads(capsys.readouterr().out)['outcome'] == 'error'
+
+
+def test_server_timing():
+    t = timing.Timing('/v1/events/')
+    t.add('verify_signature', 0.0012)
+    assert t.server_timing().startswith('verify_signature;dur=1.20, total;dur=')
+
+
+def test_middleware(capsys):
+    client = TestClient(app)
+    res = client.post('/v1/events/', json={'type': 'url_verification', 'token': 'token', 'challenge': 'challenge'})
+    assert 'total;dur=' in res.headers['server-timing']
+    log = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert log['operation'] == '/v1/events/'
+    assert log['outcome'] == 'url_verification'
+    assert log['status'] == 200
+
+
+def test_middleware_not_found(capsys):
+    client = TestClient(app)
+    res = client.get('/unknown')
+    assert res.status_code == 404
+    log = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert log['operation'] == 'not_found'
+    assert log['outcome'] == 'rejected'
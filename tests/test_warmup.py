@@ -0,0 +1,78 @@
+import asyncio
+import time
+from unittest import mock
+
+from moto import mock_dynamodb2
+
+from app import app_handler, warmup
+from app.emojis import custom_emoji_cache
+from app.models import TeamConf, plaintext_cache, team_conf_cache
+from app.settings import settings
+
+
+@mock_dynamodb2
+def test_load_team_confs():
+    TeamConf.create_table()
+    for i in range(3):
+        TeamConf(f'T{i:010d}', access_token=f'xoxb-{i}').save()
+    team_conf_cache.clear()
+    plaintext_cache.clear()
+    team_confs = warmup.load_team_confs(limit=2)
+    assert len(team_confs) == 2
+    assert len(team_conf_cache) == 2
+    # アクセストークンは読み込んだ時点で復号されている
+    assert len(plaintext_cache) == 2
+    with mock.patch('pynamodb.connection.table.TableConnection.get_item') as get_item:
+        TeamConf.get(team_confs[0].team_id)
+        get_item.assert_not_called()
+
+
+@mock_dynamodb2
+def test_load_team_confs_ttl():
+    """温めたTeamConfは次に温めるまで失効しない"""
+    TeamConf.create_table()
+    TeamConf('T0000000000', access_token='xoxb-0').save()
+    team_conf_cache.clear()
+    warmup.load_team_confs(limit=1)
+    with mock.patch('time.monotonic', return_value=time.monotonic() + settings.TEAM_CONF_CACHE_TTL + 1):
+        assert 'T0000000000' in team_conf_cache
+    with mock.patch('time.monotonic', return_value=time.monotonic() + settings.WARM_UP_TTL + 1):
+        assert 'T0000000000' not in team_conf_cache
+
+
+@mock_dynamodb2
+@mock.patch('app.warmup.open_connections', mock.AsyncMock())
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.emoji_list',
+            mock.AsyncMock(return_value={'emoji': {'example': 'https://emoji.com/example.png'}}))
+def test_warm_up_custom_emoji():
+    TeamConf.create_table()
+    TeamConf('T0000000000', access_token='xoxb-0').save()
+    with mock.patch.object(settings, 'WARM_UP_CUSTOM_EMOJI', True):
+        asyncio.get_event_loop().run_until_complete(warmup.warm_up())
+    assert custom_emoji_cache.get('T0000000000') == {'example'}
+
+
+@mock_dynamodb2
+@mock.patch('app.warmup.open_connections', mock.AsyncMock())
+def test_warm_up_failure():
+    """テーブルに接続できなくても起動は続ける"""
+    asyncio.get_event_loop().run_until_complete(warmup.warm_up())
+    assert len(team_conf_cache) == 0
+
+
+def test_is_warm_up_event():
+    assert warmup.is_warm_up_event({'warmup': True})
+    assert not warmup.is_warm_up_event({'httpMethod': 'POST', 'path': '/v1/events/'})
+
+
+@mock_dynamodb2
+@mock.patch('app.warmup.open_connections', mock.AsyncMock())
+def test_app_handler_warm_up():
+    """スケジュール実行のイベントではリクエストとして処理せずに温める"""
+    TeamConf.create_table()
+    TeamConf('T0000000000', access_token='xoxb-0').save()
+    team_conf_cache.clear()
+    with mock.patch('app.asgi_handler') as asgi_handler:
+        assert app_handler({'warmup': True}, None) == {'warmed_up': 1}
+        asgi_handler.assert_not_called()
+    assert 'T0000000000' in team_conf_cache
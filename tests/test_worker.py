@@ -0,0 +1,50 @@
+import asyncio
+from unittest import mock
+
+from app import metrics
+from app.worker import WorkQueue
+
+
+def test_enqueue_and_drain():
+    queue = WorkQueue('test_queue', concurrency=2, maxsize=10)
+    results = []
+
+    async def job(value):
+        await asyncio.sleep(0)
+        results.append(value)
+
+    async def run():
+        for i in range(5):
+            await queue.enqueue(job, i)
+        await queue.drain()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert sorted(results) == [0, 1, 2, 3, 4]
+    assert queue.depth == 0
+
+
+def test_enqueue_queue_full_runs_inline():
+    queue = WorkQueue('test_queue_full', concurrency=1, maxsize=1)
+    job = mock.AsyncMock()
+
+    async def run():
+        await queue.enqueue(job, 1)
+        await queue.enqueue(job, 2)  # ワーカーが動く前にキューが溢れる
+        job.assert_awaited_once_with(2)
+        await queue.drain()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert job.await_count == 2
+    assert metrics.counters['test_queue_full.inline'] == 1
+
+
+def test_failed_job():
+    queue = WorkQueue('test_queue_failed', concurrency=1, maxsize=1)
+    job = mock.AsyncMock(side_effect=Exception)
+
+    async def run():
+        await queue.enqueue(job)
+        await queue.drain()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert metrics.counters['test_queue_failed.failed'] == 1
@@ -6,30 +6,14 @@ from fastapi.testclient import TestClient
 from moto import mock_dynamodb2
 
 from app import app, models
+from app.digest import item_blocks
 from tests.factories import get_object
 
 client = TestClient(app)
 
 
-def test_redirect_to_view_submission():
-    payload = {
-        'type': 'view_submission',
-        'team': {
-            'id': 'T0000000000',
-            'domain': 'team_domain'
-        },
-        'user': {
-            'id': 'U00XXXXXXX',
-            'team_id': 'T0000000000'
-        },
-    }
-    data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/', data=data, allow_redirects=False)
-    assert res.status_code == HTTPStatus.TEMPORARY_REDIRECT
-    assert res.headers['location'] == './view_submission/'
-
-
-def test_redirect_to_shortcuts():
+def test_unknown_action():
+    """対応する処理がないpayloadは何もしない"""
     payload = {
         'type': 'shortcut',
         'team': {
@@ -40,32 +24,13 @@ def test_redirect_to_shortcuts():
             'id': 'U00XXXXXXX',
             'team_id': 'T0000000000'
         },
+        'callback_id': 'unknown',
     }
     data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/', data=data, allow_redirects=False)
-    assert res.status_code == HTTPStatus.TEMPORARY_REDIRECT
-    assert res.headers['location'] == './shortcuts/'
-
-
-def test_redirect_to_message():
-    payload = {
-        'type': 'block_actions',
-        'team': {
-            'id': 'T0000000000',
-            'domain': 'team_domain'
-        },
-        'container': {
-            'type': 'message'
-        },
-        'user': {
-            'id': 'U00XXXXXXX',
-            'team_id': 'T0000000000'
-        },
-    }
-    data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/', data=data, allow_redirects=False)
-    assert res.status_code == HTTPStatus.TEMPORARY_REDIRECT
-    assert res.headers['location'] == './message/'
+    with mock.patch('app.models.TeamConf.get') as get:
+        res = client.post('/v1/actions/', data=data)
+        get.assert_not_called()
+    assert res.status_code == HTTPStatus.OK
 
 
 @mock.patch('app.models.TeamConf.get', mock.Mock(side_effect=models.TeamConf.DoesNotExist))
@@ -80,14 +45,15 @@ def test_shortcut_teamconf_doesnot_exists():
             'id': 'U00XXXXXXX',
             'team_id': 'T0000000000'
         },
+        'callback_id': 'edit_emoji_set',
     }
     data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/shortcuts/', data=data)
+    res = client.post('/v1/actions/', data=data)
     assert res.status_code == HTTPStatus.BAD_REQUEST
 
 
 @mock_dynamodb2
-@mock.patch('slack_sdk.web.base_client.BaseClient.api_call', lambda x, *y, **z:...)
+@mock.patch('slack_sdk.web.async_base_client.AsyncBaseClient.api_call', mock.AsyncMock())
 def test_shortcut_add_emoji_set():
     models.TeamConf.create_table()
     models.TeamConf('T0000000000', access_token='access_token').save()
@@ -105,12 +71,12 @@ def test_shortcut_add_emoji_set():
         'trigger_id': 'trigger_id',
     }
     data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/shortcuts/', data=data)
+    res = client.post('/v1/actions/', data=data)
     assert res.status_code == HTTPStatus.OK
 
 
 @mock.patch('app.models.TeamConf.get', get_object)
-@mock.patch('slack_sdk.web.base_client.BaseClient.api_call', lambda x, *y, **z:...)
+@mock.patch('slack_sdk.web.async_base_client.AsyncBaseClient.api_call', mock.AsyncMock())
 def test_shortcut_edit_emoji_set():
     payload = {
         'type': 'shortcut',
@@ -126,12 +92,12 @@ def test_shortcut_edit_emoji_set():
         'trigger_id': 'trigger_id',
     }
     data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/shortcuts/', data=data)
+    res = client.post('/v1/actions/', data=data)
     assert res.status_code == HTTPStatus.OK
 
 
 @mock.patch('app.models.TeamConf.get', get_object)
-@mock.patch('slack_sdk.web.base_client.BaseClient.api_call', lambda x, *y, **z:...)
+@mock.patch('slack_sdk.web.async_base_client.AsyncBaseClient.api_call', mock.AsyncMock())
 def test_shortcut_edit_emoji_set():
     payload = {
         'type': 'shortcut',
@@ -147,7 +113,7 @@ def test_shortcut_edit_emoji_set():
         'trigger_id': 'trigger_id',
     }
     data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/shortcuts/', data=data)
+    res = client.post('/v1/actions/', data=data)
     assert res.status_code == HTTPStatus.OK
 
 
@@ -176,13 +142,13 @@ def test_message_team_conf_does_not_exist():
         }
     }
     data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/message/', data=data)
+    res = client.post('/v1/actions/', data=data)
     assert res.status_code == HTTPStatus.BAD_REQUEST
 
 
 @mock.patch('app.models.TeamConf.get', get_object)
-@mock.patch('slack_sdk.web.base_client.BaseClient.api_call', lambda x, *y, **z:...)
-def test_message():
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_delete', new_callable=mock.AsyncMock)
+def test_message(chat_delete):
     payload = {
         'type': 'block_actions',
         'team': {
@@ -206,8 +172,9 @@ def test_message():
         }
     }
     data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/message/', data=data)
+    res = client.post('/v1/actions/', data=data)
     assert res.status_code == HTTPStatus.OK
+    chat_delete.assert_awaited_once_with(channel='channel_id', ts='1629922334.000700')
 
 
 @mock.patch('app.models.TeamConf.get', mock.Mock(side_effect=models.TeamConf.DoesNotExist))
@@ -237,12 +204,13 @@ def test_view_submission_team_conf_does_not_exist():
         }
     }
     data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/view_submission/', data=data)
+    res = client.post('/v1/actions/', data=data)
     assert res.status_code == HTTPStatus.BAD_REQUEST
 
 
 @mock_dynamodb2
-@mock.patch('slack_sdk.WebClient.emoji_list', lambda x: {'emoji': {'example': 'https://emoji.com/example.png'}})
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.emoji_list',
+            mock.AsyncMock(return_value={'emoji': {'example': 'https://emoji.com/example.png'}}))
 def test_view_submission_add_emoji():
     models.TeamConf.create_table()
     team_conf = models.TeamConf('T0000000000', access_token='access_token')
@@ -284,7 +252,7 @@ def test_view_submission_add_emoji():
         }
     }
     data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/view_submission/', data=data)
+    res = client.post('/v1/actions/', data=data)
     team_conf.refresh()
     assert len(team_conf.emoji_set) == 1
     assert 'example' in team_conf.emoji_set
@@ -292,7 +260,7 @@ def test_view_submission_add_emoji():
 
 
 @mock_dynamodb2
-@mock.patch('slack_sdk.WebClient.emoji_list', lambda x: {'emoji': {}})
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.emoji_list', mock.AsyncMock(return_value={'emoji': {}}))
 def test_view_submission_add_unregistered_emoji():
     """存在しないemojiを入力したケース
     """
@@ -336,7 +304,7 @@ def test_view_submission_add_unregistered_emoji():
         }
     }
     data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/view_submission/', data=data)
+    res = client.post('/v1/actions/', data=data)
     team_conf.refresh()
     assert team_conf.emoji_set is None
     assert res.status_code == HTTPStatus.OK
@@ -344,7 +312,7 @@ def test_view_submission_add_unregistered_emoji():
 
 
 @mock_dynamodb2
-@mock.patch('slack_sdk.WebClient.emoji_list', lambda x: {'emoji': {}})
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.emoji_list', mock.AsyncMock(return_value={'emoji': {}}))
 def test_view_submission_remove_emoji():
     """emojiを削除"""
     models.TeamConf.create_table()
@@ -387,7 +355,161 @@ def test_view_submission_remove_emoji():
         }
     }
     data = {'payload': json.dumps(payload)}
-    res = client.post('/v1/actions/view_submission/', data=data)
+    res = client.post('/v1/actions/', data=data)
     team_conf.refresh()
     assert res.status_code == HTTPStatus.OK
     assert team_conf.emoji_set is None
+
+
+@mock_dynamodb2
+@mock.patch('app.models.TeamConf.get', get_object)
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_delete', new_callable=mock.AsyncMock)
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_update', new_callable=mock.AsyncMock)
+def test_message_digest(chat_update, chat_delete):
+    """まとめて送ったDMの「読んだ」ボタンを押したケース"""
+    models.SavedItem.create_table()
+    models.SavedItem.create('T0000000000', 'U00XXXXXXX', 'channel_id', '1629891004.013500', 'https://example.com')
+    blocks = [{'type': 'section', 'block_id': 'header'}]
+    for item_key in ['channel_id:1629891004.013500', 'channel_id:1629891005.013500']:
+        blocks += [block.to_dict() for block in item_blocks(item_key, 'https://example.com')]
+    payload = {
+        'type': 'block_actions',
+        'team': {
+            'id': 'T0000000000',
+            'domain': 'team_domain'
+        },
+        'user': {
+            'id': 'U00XXXXXXX',
+            'team_id': 'T0000000000'
+        },
+        'actions': [{
+            'action_id': 'mark_as_read',
+            'value': 'channel_id:1629891004.013500',
+            'type': 'button',
+            'action_ts': '1629922346.043279'
+        }],
+        'container': {
+            'type': 'message',
+            'message_ts': '1629922334.000700',
+            'channel_id': 'channel_id',
+        },
+        'message': {
+            'ts': '1629922334.000700',
+            'blocks': blocks,
+        },
+    }
+    data = {'payload': json.dumps(payload)}
+    res = client.post('/v1/actions/', data=data)
+    assert res.status_code == HTTPStatus.OK
+    chat_delete.assert_not_called()
+    chat_update.assert_awaited_once()
+    assert len(chat_update.call_args.kwargs['blocks']) == 3
+    # 保存したメッセージも既読になる
+    saved_items = models.SavedItem.find('T0000000000', 'U00XXXXXXX', 'channel_id:1629891004.013500')
+    assert [saved.is_read for saved in saved_items] == [True]
+
+
+@mock_dynamodb2
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.emoji_list', mock.AsyncMock(return_value={'emoji': {}}))
+def test_view_submission_delivery_mode():
+    """DMの送り方を変更"""
+    models.TeamConf.create_table()
+    team_conf = models.TeamConf('T0000000000', access_token='access_token')
+    team_conf.save()
+    payload = {
+        'type': 'view_submission',
+        'team': {
+            'id': 'T0000000000',
+            'domain': 'team_domain'
+        },
+        'user': {
+            'id': 'U00XXXXXXX',
+            'team_id': 'T0000000000'
+        },
+        'view': {
+            'callback_id': 'edit_emoji_set',
+            'state': {
+                'values': {
+                    'emoji_0': {
+                        'emoji_0': {
+                            'type': 'plain_text_input',
+                            'value': ':+1:'
+                        }
+                    },
+                    'delivery_mode': {
+                        'delivery_mode': {
+                            'type': 'radio_buttons',
+                            'selected_option': {
+                                'value': 'digest'
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+    data = {'payload': json.dumps(payload)}
+    res = client.post('/v1/actions/', data=data)
+    team_conf.refresh()
+    assert res.status_code == HTTPStatus.OK
+    assert team_conf.emoji_set == {'+1'}
+    assert team_conf.is_digest
+
+
+@mock_dynamodb2
+@mock.patch('app.models.TeamConf.get', get_object)
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.views_publish', new_callable=mock.AsyncMock)
+def test_message_app_home(views_publish):
+    """App Homeの一覧で「読んだ」ボタンを押したケース"""
+    models.SavedItem.create_table()
+    models.SavedItem.create('T0000000000', 'U00XXXXXXX', 'channel_id', '1629891004.013500', 'https://example.com')
+    payload = {
+        'type': 'block_actions',
+        'team': {
+            'id': 'T0000000000',
+            'domain': 'team_domain'
+        },
+        'user': {
+            'id': 'U00XXXXXXX',
+            'team_id': 'T0000000000'
+        },
+        'actions': [{
+            'action_id': 'mark_as_read',
+            'value': 'channel_id:1629891004.013500',
+            'type': 'button',
+            'action_ts': '1629922346.043279'
+        }],
+        'container': {
+            'type': 'view',
+            'view_id': 'V0000000000',
+        },
+    }
+    data = {'payload': json.dumps(payload)}
+    # lifespanのshutdownで描画し直す
+    with client:
+        res = client.post('/v1/actions/', data=data)
+    assert res.status_code == HTTPStatus.OK
+    views_publish.assert_awaited_once()
+    blocks = views_publish.call_args.kwargs['view']['blocks']
+    assert blocks[1]['text']['text'] == '未読のメッセージはありません'
+
+
+@mock.patch('app.models.TeamConf.get', get_object)
+@mock.patch('app.bulk.start', new_callable=mock.AsyncMock)
+def test_shortcut_mark_all_as_read(start):
+    payload = {
+        'type': 'shortcut',
+        'callback_id': 'mark_all_as_read',
+        'trigger_id': 'trigger_id',
+        'team': {
+            'id': 'T0000000000',
+            'domain': 'team_domain'
+        },
+        'user': {
+            'id': 'U00XXXXXXX',
+            'team_id': 'T0000000000'
+        },
+    }
+    res = client.post('/v1/actions/', data={'payload': json.dumps(payload)})
+    assert res.status_code == HTTPStatus.OK
+    start.assert_awaited_once_with('T0000000000', 'U00XXXXXXX')
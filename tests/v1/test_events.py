@@ -1,11 +1,16 @@
-from app.models import TeamConf
+from app.models import DigestItem, ProcessedEvent, SavedItem, TeamConf, emoji_index, team_conf_cache
+import json
 from http import HTTPStatus
 from unittest import mock
 
 from fastapi.testclient import TestClient
+from moto import mock_dynamodb2
 
-from app import app
-from tests.factories import get_object
+from app import app, metrics
+from app.emojis import custom_emoji_cache
+from app.settings import settings
+from app.v1 import events
+from tests.factories import TeamConfFactory, get_object
 
 client = TestClient(app)
 
@@ -61,11 +66,12 @@ def test_reaction_not_in_team_conf():
     assert res.status_code == HTTPStatus.OK
 
 
+@mock_dynamodb2
 @mock.patch('app.models.TeamConf.get', get_object)
-@mock.patch('slack_sdk.web.base_client.BaseClient.api_call', lambda x, *args, **kwargs:...)
-@mock.patch('slack_sdk.web.client.WebClient.chat_getPermalink',
-            lambda x, *args, **kwargs: {'permalink': 'https://example.com'})
-def test_reaction_in_team_conf():
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_postMessage', new_callable=mock.AsyncMock)
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_getPermalink', new_callable=mock.AsyncMock)
+def test_reaction_in_team_conf(chat_get_permalink, chat_post_message):
+    SavedItem.create_table()
     data = {
         'type': 'event_callback',
         'token': 'token',
@@ -82,5 +88,280 @@ def test_reaction_in_team_conf():
             'event_ts': '1629935430.003400'
         },
     }
-    res = client.post('/v1/events/', json=data)
+    # lifespanのshutdownでキューに積まれた処理が完了する
+    with client:
+        res = client.post('/v1/events/', json=data)
     assert res.status_code == HTTPStatus.OK
+    chat_post_message.assert_awaited_once()
+    assert chat_post_message.call_args.kwargs['channel'] == 'U00XXXXXXX'
+    # パーマリンクはワークスペースのURLから組み立てる
+    chat_get_permalink.assert_not_called()
+    assert chat_post_message.call_args.kwargs['text'] == 'https://example.slack.com/archives/XXXXXXXXXXX/p1629891004013500'
+    # 「読んだ」ボタンには保存したメッセージのitem_keyを入れる
+    button = chat_post_message.call_args.kwargs['blocks'][1].elements[0]
+    assert button.value == 'XXXXXXXXXXX:1629891004.013500'
+    assert len(SavedItem.find('T0000000000', 'U00XXXXXXX', 'XXXXXXXXXXX:1629891004.013500')) == 1
+
+
+@mock_dynamodb2
+@mock.patch('app.models.TeamConf.get', get_object)
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_postMessage', new_callable=mock.AsyncMock)
+def test_reaction_handed_off(chat_post_message):
+    """EVENT_FUNCTIONを指定した場合はLambdaに任せてすぐにレスポンスを返し、任された関数でDMを送る"""
+    SavedItem.create_table()
+    data = {
+        'type': 'event_callback',
+        'token': 'token',
+        'team_id': 'T0000000000',
+        'event': {
+            'type': 'reaction_added',
+            'user': 'U00XXXXXXX',
+            'item': {
+                'type': 'message',
+                'channel': 'XXXXXXXXXXX',
+                'ts': '1629891004.013500'
+            },
+            'reaction': 'atodeyomu',
+            'event_ts': '1629935430.003400'
+        },
+    }
+    with mock.patch.object(settings, 'EVENT_FUNCTION', 'atodeyomu-test-event'), \
+            mock.patch('app.worker.get_lambda_client') as get_lambda_client, client:
+        res = client.post('/v1/events/', json=data)
+    assert res.status_code == HTTPStatus.OK
+    chat_post_message.assert_not_called()
+    kwargs = get_lambda_client.return_value.invoke.call_args.kwargs
+    assert kwargs['FunctionName'] == 'atodeyomu-test-event'
+    assert kwargs['InvocationType'] == 'Event'
+    events.handler(json.loads(kwargs['Payload']), None)
+    chat_post_message.assert_awaited_once()
+    assert chat_post_message.call_args.kwargs['channel'] == 'U00XXXXXXX'
+
+@mock_dynamodb2
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_postMessage', new_callable=mock.AsyncMock)
+@mock.patch(
+    'slack_sdk.web.async_client.AsyncWebClient.chat_getPermalink',
+    mock.AsyncMock(return_value={'permalink': 'https://example.slack.com/archives/XXXXXXXXXXX/p1629891004013500'}),
+)
+def test_reaction_without_workspace_url(chat_post_message):
+    """ワークスペースのURLが保存されていない場合はchat.getPermalinkで取得してURLを保存する"""
+    TeamConf.create_table()
+    SavedItem.create_table()
+    TeamConf('T0000000000', access_token='access_token', emoji_set={'atodeyomu'}).save()
+    data = {
+        'type': 'event_callback',
+        'token': 'token',
+        'team_id': 'T0000000000',
+        'event': {
+            'type': 'reaction_added',
+            'user': 'U00XXXXXXX',
+            'item': {
+                'type': 'message',
+                'channel': 'XXXXXXXXXXX',
+                'ts': '1629891004.013500'
+            },
+            'reaction': 'atodeyomu',
+            'event_ts': '1629935430.003400'
+        },
+    }
+    with client:
+        res = client.post('/v1/events/', json=data)
+    assert res.status_code == HTTPStatus.OK
+    chat_post_message.assert_awaited_once()
+    assert TeamConf.get('T0000000000', consistent_read=True).url == 'https://example.slack.com/'
+
+
+@mock_dynamodb2
+@mock.patch('app.models.TeamConf.get', get_object)
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_postMessage', new_callable=mock.AsyncMock)
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_getPermalink',
+            mock.AsyncMock(return_value={'permalink': 'https://example.com'}))
+def test_retried_event(chat_post_message):
+    """Slackから同じイベントが再送されたケース"""
+    ProcessedEvent.create_table()
+    SavedItem.create_table()
+    data = {
+        'type': 'event_callback',
+        'token': 'token',
+        'team_id': 'T0000000000',
+        'event_id': 'Ev0000000000',
+        'event': {
+            'type': 'reaction_added',
+            'user': 'U00XXXXXXX',
+            'item': {
+                'type': 'message',
+                'channel': 'XXXXXXXXXXX',
+                'ts': '1629891004.013500'
+            },
+            'reaction': 'atodeyomu',
+            'event_ts': '1629935430.003400'
+        },
+    }
+    with client:
+        res = client.post('/v1/events/', json=data)
+        assert res.status_code == HTTPStatus.OK
+        res = client.post('/v1/events/', json=data, headers={'X-Slack-Retry-Num': '1'})
+        assert res.status_code == HTTPStatus.OK
+    chat_post_message.assert_awaited_once()
+    assert metrics.counters['events.duplicates_suppressed'] == 1
+
+
+def test_emoji_changed():
+    custom_emoji_cache.set('T0000000000', {'example'})
+    data = {
+        'type': 'event_callback',
+        'token': 'token',
+        'team_id': 'T0000000000',
+        'event': {
+            'type': 'emoji_changed',
+            'subtype': 'add',
+            'name': 'added',
+            'value': 'https://emoji.com/added.png',
+            'event_ts': '1629935430.003400'
+        },
+    }
+    with mock.patch('app.models.TeamConf.get') as get:
+        res = client.post('/v1/events/', json=data)
+        get.assert_not_called()
+    assert res.status_code == HTTPStatus.OK
+    assert custom_emoji_cache.get('T0000000000') == {'example', 'added'}
+
+
+@mock_dynamodb2
+@mock.patch('app.models.TeamConf.get', get_object)
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_postMessage', new_callable=mock.AsyncMock)
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_getPermalink',
+            mock.AsyncMock(return_value={'permalink': 'https://example.com'}))
+def test_reaction_with_skin_tone(chat_post_message):
+    """肌の色を指定したリアクションも設定されたemojiとして扱う"""
+    SavedItem.create_table()
+    data = {
+        'type': 'event_callback',
+        'token': 'token',
+        'team_id': 'T0000000000',
+        'event': {
+            'type': 'reaction_added',
+            'user': 'U00XXXXXXX',
+            'item': {
+                'type': 'message',
+                'channel': 'XXXXXXXXXXX',
+                'ts': '1629891004.013500'
+            },
+            'reaction': 'atodeyomu::skin-tone-2',
+            'event_ts': '1629935430.003400'
+        },
+    }
+    with client:
+        res = client.post('/v1/events/', json=data)
+    assert res.status_code == HTTPStatus.OK
+    chat_post_message.assert_awaited_once()
+
+
+@mock_dynamodb2
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.chat_postMessage', new_callable=mock.AsyncMock)
+def test_reaction_digest(chat_post_message):
+    """まとめてDMを送る設定のチームはDMを送らずに保存する"""
+    DigestItem.create_table()
+    SavedItem.create_table()
+    data = {
+        'type': 'event_callback',
+        'token': 'token',
+        'team_id': 'T0000000000',
+        'event': {
+            'type': 'reaction_added',
+            'user': 'U00XXXXXXX',
+            'item': {
+                'type': 'message',
+                'channel': 'XXXXXXXXXXX',
+                'ts': '1629891004.013500'
+            },
+            'reaction': 'atodeyomu',
+            'event_ts': '1629935430.003400'
+        },
+    }
+    with mock.patch('app.models.TeamConf.get', lambda *args, **kwargs: TeamConfFactory(delivery_mode='digest')):
+        with client:
+            res = client.post('/v1/events/', json=data)
+    assert res.status_code == HTTPStatus.OK
+    chat_post_message.assert_not_called()
+    item = DigestItem.get('T0000000000:U00XXXXXXX', 'XXXXXXXXXXX:1629891004.013500')
+    assert item.permalink == 'https://example.slack.com/archives/XXXXXXXXXXX/p1629891004013500'
+
+
+def test_invalid_json():
+    res = client.post('/v1/events/', data=b'{"type": ', headers={'content-type': 'application/json'})
+    assert res.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_invalid_event():
+    res = client.post('/v1/events/', json={'type': 'event_callback'})
+    assert res.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+def test_event_without_team_id():
+    res = client.post('/v1/events/', json={'type': 'event_callback', 'token': 'token'})
+    assert res.status_code == HTTPStatus.BAD_REQUEST
+
+
+@mock_dynamodb2
+@mock.patch('app.models.TeamConf.get', get_object)
+@mock.patch('slack_sdk.web.async_client.AsyncWebClient.views_publish', new_callable=mock.AsyncMock)
+def test_app_home_opened(views_publish):
+    SavedItem.create_table()
+    data = {
+        'type': 'event_callback',
+        'token': 'token',
+        'team_id': 'T0000000000',
+        'event': {
+            'type': 'app_home_opened',
+            'user': 'U00XXXXXXX',
+            'channel': 'D0000000000',
+            'tab': 'home',
+            'event_ts': '1629935430.003400'
+        },
+    }
+    with client:
+        res = client.post('/v1/events/', json=data)
+        assert res.status_code == HTTPStatus.OK
+        # 公開したビューが表示されている場合は公開し直さない
+        data['event']['view'] = {'private_metadata': views_publish.call_args.kwargs['view']['private_metadata']}
+        res = client.post('/v1/events/', json=data)
+        assert res.status_code == HTTPStatus.OK
+    views_publish.assert_awaited_once()
+    assert views_publish.call_args.kwargs['user_id'] == 'U00XXXXXXX'
+
+
+@mock_dynamodb2
+def test_reaction_prefiltered():
+    """設定されていないemojiのリアクションはアクセストークンを読み込まずに無視する"""
+    TeamConf.create_table()
+    TeamConf('T0000000000', access_token='access_token', emoji_set={'atodeyomu'}).save()
+    emoji_index.clear()
+    team_conf_cache.clear()
+    data = {
+        'type': 'event_callback',
+        'token': 'token',
+        'team_id': 'T0000000000',
+        'event': {
+            'type': 'reaction_added',
+            'user': 'U00XXXXXXX',
+            'item': {
+                'type': 'message',
+                'channel': 'XXXXXXXXXXX',
+                'ts': '1629891004.013500'
+            },
+            'reaction': 'hogehoge',
+            'event_ts': '1629935430.003400'
+        },
+    }
+    with mock.patch('app.models.EncryptedStringAttribute.deserialize') as deserialize:
+        res = client.post('/v1/events/', json=data)
+        assert res.status_code == HTTPStatus.OK
+        deserialize.assert_not_called()
+    assert 'T0000000000' not in team_conf_cache
+    # 2回目以降はDynamoDBにも問い合わせない
+    with mock.patch('pynamodb.connection.table.TableConnection.get_item') as get_item:
+        res = client.post('/v1/events/', json=data)
+        assert res.status_code == HTTPStatus.OK
+        get_item.assert_not_called()
+    assert metrics.counters['events.prefiltered'] == 2
@@ -1,12 +1,14 @@
 import json
 from http import HTTPStatus
 from datetime import datetime
+from unittest import mock
+from urllib.parse import parse_qs, urlencode
 
 from fastapi.testclient import TestClient
 from slack_sdk.signature import SignatureVerifier
 
 from app import app
-from app.dependencies import verify_signature
+from app.dependencies import decode_body, parse_form, verify_signature
 from app.settings import settings
 
 
@@ -27,3 +29,61 @@ def test_verified():
     headers = {'x-slack-request-timestamp': str(timestamp), 'x-slack-signature': signature}
     res = client.post('/v1/events/', json=data, headers=headers)
     assert res.status_code == HTTPStatus.OK
+
+
+def test_verified_form():
+    """フォームで送られたpayloadも同じボディで検証して読み込む"""
+    app.dependency_overrides[verify_signature] = verify_signature
+    client = TestClient(app)
+    timestamp = str(int(datetime.now().timestamp()))
+    payload = {'type': 'shortcut', 'team': {'id': 'T0000000000', 'domain': 'd'}, 'callback_id': 'unknown'}
+    body = urlencode({'payload': json.dumps(payload)})
+    signature = SignatureVerifier(settings.SLACK_SIGNING_SECRET).generate_signature(timestamp=timestamp, body=body)
+    headers = {
+        'content-type': 'application/x-www-form-urlencoded',
+        'x-slack-request-timestamp': timestamp,
+        'x-slack-signature': signature,
+    }
+    res = client.post('/v1/actions/', data=body, headers=headers)
+    assert res.status_code == HTTPStatus.OK
+
+
+@mock.patch('app.dependencies.SignatureVerifier.generate_signature')
+def test_expired_timestamp(generate_signature):
+    """タイムスタンプが古いリクエストは署名を計算せずに拒否する"""
+    app.dependency_overrides[verify_signature] = verify_signature
+    client = TestClient(app)
+    timestamp = int(datetime.now().timestamp()) - 60 * 10
+    headers = {'x-slack-request-timestamp': str(timestamp), 'x-slack-signature': 'v0=signature'}
+    res = client.post('/v1/events/', json={'type': 'url_verification', 'token': 'token'}, headers=headers)
+    assert res.status_code == HTTPStatus.FORBIDDEN
+    generate_signature.assert_not_called()
+
+
+def test_invalid_timestamp():
+    app.dependency_overrides[verify_signature] = verify_signature
+    client = TestClient(app)
+    headers = {'x-slack-request-timestamp': 'invalid', 'x-slack-signature': 'v0=signature'}
+    res = client.post('/v1/events/', json={'type': 'url_verification', 'token': 'token'}, headers=headers)
+    assert res.status_code == HTTPStatus.FORBIDDEN
+
+
+def test_decode_body():
+    assert decode_body(b'payload=%7B%22type%22%3A+%22shortcut%22%7D', 'application/x-www-form-urlencoded') == {
+        'type': 'shortcut'
+    }
+    assert decode_body(b'{"type": "url_verification"}', 'application/json') == {'type': 'url_verification'}
+    assert decode_body(b'', 'application/json') == {}
+
+
+def test_decode_form_same_as_parse_qs():
+    payload = json.dumps({'text': 'あとで 読む+%=&\n😀', 'blocks': [{'type': 'section'}]}, ensure_ascii=False)
+    body = urlencode({'payload': payload, 'extra': 'a b'}).encode()
+    assert decode_body(body, 'application/x-www-form-urlencoded') == json.loads(parse_qs(body.decode())['payload'][0])
+    assert parse_form(body) == {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+
+def test_parse_malformed_form_same_as_parse_qs():
+    """正しくエンコードされていない値もparse_qsと同じ結果にする"""
+    for body in [b'text=100%zz', b'text=100%', b'text=%e3%81%82%2', b'text=a=b', b'text=a%0D%0A=+b']:
+        assert parse_form(body) == {key: values[0] for key, values in parse_qs(body.decode()).items()}